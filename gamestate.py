@@ -19,12 +19,21 @@
 
 import itertools
 import collections
+import threading
+import traceback
 import time
 
 import nes, nes.fceu
-from nes import tetris
+from nes import tetris, romid
+from nes.ram import Ram, as_view
+from nes.regions import RegionWatcher
+from nes.snapshot import FrameCapture
+from metrics import LatencyHistogram, Metric, COUNTER, GAUGE, HISTOGRAM
 
 class Dispatcher:
+    # Whether callbacks run some time after the signal is emitted
+    deferred = False
+
     def __init__(self):
         self.callbacks = collections.defaultdict(list)
     
@@ -34,9 +43,126 @@ class Dispatcher:
     def remove(self, signal, callback):
         self.callbacks[signal].remove(callback)
 
-    def emit(self, signal):
+    def emit(self, signal, *args):
         for callback in self.callbacks[signal]:
-            callback()
+            callback(*args)
+
+# Shared by all the queued dispatchers, so the number of threads doesn't
+# grow with the number of cabinets
+handler_pool = None
+
+def get_handler_pool():
+    global handler_pool
+    if handler_pool is None:
+        # Imported here since it's slow to load (it pulls in logging)
+        import concurrent.futures
+
+        handler_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix='handler')
+    return handler_pool
+
+class QueuedDispatcher(Dispatcher):
+    """Queues signals up and runs their callbacks on a worker thread, so a
+    slow callback never holds up whoever emitted the signal. Signals are
+    still handled one at a time, in the order they were emitted.
+
+    The queue is bounded, but only the droppable signals (by default just
+    next-piece) are ever dropped. When it's full, the overflow policy
+    decides whether the oldest queued droppable signal is dropped to make
+    room (DROP_OLDEST) or the new one is (DROP_NEWEST). Either way the drop
+    is counted. Lifecycle signals like finished-game are always queued, even
+    if that takes the queue over its limit.
+
+    For each signal we keep histograms of how long it waited in the queue
+    and how long its callbacks took to run."""
+
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    DROPPABLE = frozenset(['next-piece'])
+
+    deferred = True
+
+    def __init__(self, max_queued=64, overflow=DROP_OLDEST, pool=None,
+                 droppable=DROPPABLE):
+        super().__init__()
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.droppable = frozenset(droppable)
+        self.pool = pool or get_handler_pool()
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.running = False
+        self.wait_times = collections.defaultdict(LatencyHistogram)
+        self.run_times = collections.defaultdict(LatencyHistogram)
+        self.dropped = collections.Counter()
+        self.emitted = collections.Counter()
+
+    def emit(self, signal, *args):
+        event = (signal, args, time.monotonic())
+        self.emitted[signal] += 1
+        with self.lock:
+            if len(self.queue) >= self.max_queued:
+                victim = None
+                if self.overflow == self.DROP_OLDEST:
+                    victim = self.find_oldest_droppable()
+                if victim is not None:
+                    self.dropped[self.queue[victim][0]] += 1
+                    del self.queue[victim]
+                elif signal in self.droppable:
+                    self.dropped[signal] += 1
+                    return
+
+            self.queue.append(event)
+            if self.running:
+                return
+            self.running = True
+        self.pool.submit(self.drain)
+
+    def find_oldest_droppable(self):
+        '''Returns the index of the oldest queued signal that can be
+        dropped, or None if there isn't one'''
+        for n, (signal, args, emitted) in enumerate(self.queue):
+            if signal in self.droppable:
+                return n
+        return None
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.running = False
+                    return
+                signal, args, emitted = self.queue.popleft()
+
+            start = time.monotonic()
+            self.wait_times[signal].record(start-emitted)
+            for callback in self.callbacks[signal]:
+                try:
+                    callback(*args)
+                except Exception:
+                    traceback.print_exc()
+            self.run_times[signal].record(time.monotonic()-start)
+
+    def collect_metrics(self, labels):
+        yield Metric('nes_signal_queue_length', GAUGE,
+                     'Signals waiting to be handled', labels, len(self.queue))
+        # Handlers add to these from another thread, so take a copy first
+        for signal, count in list(self.emitted.items()):
+            yield Metric('nes_signals_emitted_total', COUNTER,
+                         'Game state signals emitted',
+                         dict(labels, signal=signal), count)
+        for signal, count in list(self.dropped.items()):
+            yield Metric('nes_signals_dropped_total', COUNTER,
+                         'Signals dropped because the queue was full',
+                         dict(labels, signal=signal), count)
+        for signal, histogram in list(self.wait_times.items()):
+            yield Metric('nes_signal_wait_seconds', HISTOGRAM,
+                         'Time signals spent queued',
+                         dict(labels, signal=signal), histogram)
+        for signal, histogram in list(self.run_times.items()):
+            yield Metric('nes_signal_run_seconds', HISTOGRAM,
+                         'Time taken by signal handlers',
+                         dict(labels, signal=signal), histogram)
 
 def delegate(obj_name, func_name):
     def wrapper(self, *args, **kwargs):
@@ -51,52 +177,140 @@ class GameState:
     IDLE = 0
     PLAYING = 1
     FINISHING = 2
-
+    # The ROM has started, but hasn't cleared its score area yet
+    WAITING_FOR_INIT = 3
+    # Waiting for the ROM to set up its high-score table
+    WAITING_FOR_TABLE = 4
+
+    state = IDLE
+    # The emulator's RAM, and the consistent copy of it we decode from
+    # (taken at the start of every update)
+    ram = None
+    capture = None
+    frame = None
+    regions = None
+    game_id = None
     playing_tetris = False
     last_vertical_pos = -1
     last_score = -1
-
-    def __init__(self):
-        self.dispatcher = Dispatcher()
+    score = None
+    # Whether the last update changed state, which means the next update has
+    # to run even if nothing changed in RAM
+    state_changed = True
+    high_scores = None
+    high_scores_version = None
+    # When the ROM started, and how long it took to become ready
+    rom_start_time = None
+    boot_time = None
+
+    def __init__(self, dispatcher=None):
+        self.dispatcher = dispatcher or Dispatcher()
 
     connect = delegate('dispatcher', 'connect')
     remove = delegate('dispatcher', 'remove')
-    emit = delegate('dispatcher', 'emit')
 
-    def rom_started(self, ram):
-        '''Called when the NES rom is first started'''
+    def emit(self, signal):
+        '''Sends the signal to its callbacks along with the game state. If
+        the callbacks run later (see QueuedDispatcher) they get a snapshot,
+        since by then the live state will have moved on.'''
+        if self.dispatcher.deferred:
+            self.dispatcher.emit(signal, GameSnapshot(self))
+        else:
+            self.dispatcher.emit(signal, self)
+
+    def rom_started(self, ram, game_id=None):
+        '''Called when the NES rom is first started. If we already know
+        which game is being played (eg replaying a recording) pass it in,
+        otherwise we work it out from the RAM.'''
         self.state = self.IDLE
         self.ram = ram
+        self.rom_start_time = time.monotonic()
+        self.boot_time = None
+        self.capture = FrameCapture(
+            ram, tetris.WATCHED_REGIONS, tetris.FRAME_COUNTER)
+        self.frame = self.capture.capture()
+        self.regions = RegionWatcher(self.frame, tetris.WATCHED_REGIONS)
+        self.state_changed = True
+        self.high_scores_version = None
+
+        if game_id is None:
+            game_id = romid.identify(ram)
+        if game_id is None:
+            # The game may not have set up its RAM yet, so fall back on
+            # asking the emulator what it's running
+            game_id = nes.fceu.get_running_game()
+        self.set_game(game_id)
+
+    def set_game(self, game_id):
+        self.game_id = game_id
         # Make sure tetris is actually being played right now
-        self.playing_tetris = nes.fceu.is_tetris_running()
+        self.playing_tetris = (game_id == 'tetris')
 
         if self.playing_tetris:
             print('playing tetris')
+            # The ROM still has to initialize itself, which we follow along
+            # with in update()
+            self.state = self.WAITING_FOR_INIT
 
+    def rom_stopped(self):
+        self.ram = None
+        self.capture = None
+        self.frame = None
+        self.regions = None
+        self.game_id = None
+        self.playing_tetris = False
+
+    def update(self):
+        '''Update this game state with a snapshot of the NES ram'''
+
+        if self.game_id is None and self.ram is not None:
+            # Keep checking in case the game just hadn't initialized its
+            # RAM when it started
+            game_id = romid.identify(self.ram)
+            if game_id:
+                self.set_game(game_id)
+
+        if not self.playing_tetris:
+            return
+
+        frame = self.capture.capture()
+
+        if self.state == self.WAITING_FOR_INIT:
             # Wait until the score area is zeroed out so we can set our score
             # flag below without it getting clobbered.
-            while ram[nes.tetris.CURRENT_SCORE_START] == 255:
-                time.sleep(0.5)
+            if frame[tetris.CURRENT_SCORE_START] == 255:
+                return
 
             # Make the 'current score' non-zero, so we can use this to detect
             # when a new game is started. (ie gets zeroed out by the game)
             self.ram[tetris.CURRENT_SCORE_START] = 1
-            self.emit('rom-ready')
+            self.state = self.WAITING_FOR_TABLE
 
-    def rom_stopped(self):
-        self.ram = None
+        if self.state == self.WAITING_FOR_TABLE:
+            if not self.get_high_scores():
+                return
 
-    def update(self):
-        '''Update this game state with a snapshot of the NES ram'''
+            self.boot_time = time.monotonic() - self.rom_start_time
+            self.state = self.IDLE
+            self.state_changed = True
+            self.emit('rom-ready')
+            return
 
-        if not self.playing_tetris:
+        # Everything below depends only on the watched regions of RAM, so
+        # if none of them have changed there's nothing new to learn
+        changed = self.regions.update()
+        if not changed and not self.state_changed:
             return
+        last_state = self.state
+
+        if 'score' in changed:
+            self.score = tetris.get_current_score_bytes(frame)
+        score = self.score
 
         # Handle the case where the game goes into demo mode, which triggers
         # a start event, but never reaches the game over screen to trigger
         # the finished event. So we check for the score resetting to zero
         # which indicates a new game has started.
-        score = tetris.get_current_score_bytes(self.ram)
         if (self.state == self.PLAYING and
             score == (0, 0, 0) and
             self.last_score != score):
@@ -114,9 +328,9 @@ class GameState:
                 self.emit('started-game')
 
         elif self.state == self.PLAYING:
-            vertical_pos = self.ram[tetris.VERTICAL_POS]
+            vertical_pos = frame[tetris.VERTICAL_POS]
             
-            if self.ram[tetris.PLAY_AREA_START] == tetris.PLAY_AREA_BAR_FILL:
+            if frame[tetris.PLAY_AREA_START] == tetris.PLAY_AREA_BAR_FILL:
                 # The game is finished. Wait until the field is cleared before
                 # checking high scores. (happens after the user enters one)
                 self.state = self.FINISHING
@@ -133,29 +347,49 @@ class GameState:
             # pieces. Then it waits for the player to enter a high score before
             # clearing those pieces again. At that point we can check for a
             # new high score entry.
-            if self.ram[tetris.PLAY_AREA_START] == PLAY_AREA_EMPTY:
+            if frame[tetris.PLAY_AREA_START] == tetris.PLAY_AREA_EMPTY:
                 self.emit('finished-game')
                 self.state = self.IDLE
 
         self.last_score = score
+        self.state_changed = (self.state != last_state)
 
     def get_high_scores(self):
-        return tetris.get_high_scores(self.ram)
+        # Only decode the table again if it has changed
+        version = self.regions.refresh('high-scores')
+        if version != self.high_scores_version:
+            self.high_scores = tetris.get_high_scores(self.frame)
+            self.high_scores_version = version
+        return self.high_scores
 
     def get_current_score(self):
-        return tetris.get_current_score(self.ram)
+        return tetris.get_current_score(self.frame)
 
     def get_play_area(self):
-        ram_start = tetris.PLAY_AREA_START
-        rows = tetris.PLAY_AREA_ROWS
-        cols = tetris.PLAY_AREA_COLS
+        '''Returns a (rows x cols) array view of the play area'''
+        return tetris.get_play_area(self.frame)
 
-        ram_slice = slice(ram_start, ram_start+rows*cols)
-        ram_iter = iter(self.ram[ram_slice])
+    def get_game_stats(self):
+        return tetris.get_game_stats(self.frame)
 
-        area = [
-            [next(ram_iter) for col in range(cols)]
-            for row in range(rows)
-        ]
+class GameSnapshot:
+    '''A copy of the game state (and RAM) as it was at some point'''
+
+    def __init__(self, game_state):
+        self.state = game_state.state
+        self.game_id = game_state.game_id
+        self.boot_time = game_state.boot_time
+        self.timestamp = time.monotonic()
+        self.ram = Ram(bytes(as_view(game_state.frame)))
+
+    def get_high_scores(self):
+        return tetris.get_high_scores(self.ram)
+
+    def get_current_score(self):
+        return tetris.get_current_score(self.ram)
+
+    def get_play_area(self):
+        return tetris.get_play_area(self.ram)
 
-        return area
+    def get_game_stats(self):
+        return tetris.get_game_stats(self.ram)
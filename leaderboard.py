@@ -0,0 +1,113 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import namedtuple
+
+# A high score as stored in the leaderboard. 'cabinet' identifies where the
+# score was made and 'first_seen' is when we first noticed it (unix time).
+Score = namedtuple(
+    'Score', ('cabinet', 'game_type', 'name', 'score', 'level', 'first_seen'))
+
+SCHEMA = '''
+create table if not exists scores (
+    id integer primary key,
+    cabinet text not null,
+    game_type text not null,
+    name text not null,
+    score integer not null,
+    level integer not null,
+    first_seen real not null,
+    unique (cabinet, game_type, name, score, level)
+);
+create index if not exists scores_by_score on scores (game_type, score);
+create index if not exists scores_by_name on scores (name);
+'''
+
+class Leaderboard:
+    '''Persistent (SQLite) record of every high score seen, on every cabinet.
+    Scores are identified by the cabinet, game type, name, score and level,
+    so seeing the same entry again (eg after a restart) isn't a new score.
+    Safe to share between threads.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    @property
+    def db(self):
+        # The database is opened when first used (so sqlite is only loaded
+        # then) which keeps starting the watcher quick
+        if self.connection is None:
+            import sqlite3
+            self.connection = sqlite3.connect(
+                self.path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def add_entries(self, cabinet, entries, timestamp=None):
+        '''Records the given high-score entries, returning the ones that
+        weren't already in the leaderboard'''
+        if timestamp is None:
+            timestamp = time.time()
+
+        new_entries = []
+        with self.lock, self.db:
+            for entry in entries:
+                cursor = self.db.execute(
+                    'insert or ignore into scores '
+                    '(cabinet, game_type, name, score, level, first_seen) '
+                    'values (?, ?, ?, ?, ?, ?)',
+                    (cabinet, entry.game_type, entry.name, entry.score,
+                     entry.level, timestamp))
+                if cursor.rowcount:
+                    new_entries.append(entry)
+        return new_entries
+
+    def get_top(self, game_type, count=10, cabinet=None):
+        '''Returns the best scores of all time, optionally just for the
+        given cabinet'''
+        query = ('select cabinet, game_type, name, score, level, first_seen '
+                 'from scores where game_type = ?')
+        params = [game_type]
+        if cabinet is not None:
+            query += ' and cabinet = ?'
+            params.append(cabinet)
+        query += ' order by score desc limit ?'
+        params.append(count)
+        with self.lock:
+            return [Score(*row) for row in self.db.execute(query, params)]
+
+    def get_history(self, name):
+        '''Returns every score made under the given name, oldest first'''
+        with self.lock:
+            return [Score(*row) for row in self.db.execute(
+                'select cabinet, game_type, name, score, level, first_seen '
+                'from scores where name = ? order by first_seen', (name,))]
+
+    def get_all(self):
+        '''Returns every score, oldest first'''
+        with self.lock:
+            return [Score(*row) for row in self.db.execute(
+                'select cabinet, game_type, name, score, level, first_seen '
+                'from scores order by first_seen, id')]
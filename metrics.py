@@ -0,0 +1,204 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Latency histograms, plus a registry that exposes them (and any other
+# counters we keep) in the Prometheus text format over a local socket.
+#
+# Nothing is pushed into the registry as it happens. Instead the objects
+# being measured register a collector, which is only called when someone
+# scrapes the endpoint and just reads off the counts they already keep.
+# So when nobody is looking, metrics cost nothing beyond the counting.
+#
+
+import bisect
+import os
+import threading
+from collections import namedtuple
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# A single value yielded by a collector. For histograms the value is a
+# LatencyHistogram.
+Metric = namedtuple('Metric', ('name', 'type', 'help', 'labels', 'value'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class LatencyHistogram:
+    '''Counts durations (in seconds) into buckets that double in size, from
+    1us up to about 16s. Recording is cheap enough for the sampling loop.'''
+
+    BOUNDS = tuple(1e-6 * 2**n for n in range(25))
+
+    def __init__(self):
+        # The last bucket catches everything above the largest bound
+        self.buckets = [0] * (len(self.BOUNDS)+1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        '''Adds the counts from another histogram into this one'''
+        for n, count in enumerate(other.buckets):
+            self.buckets[n] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def get_mean(self):
+        return self.total/self.count if self.count else 0
+
+    def get_percentile(self, percent):
+        '''Returns the upper bound of the bucket holding the given
+        percentile (so it's an overestimate by at most a factor of two)'''
+        if not self.count:
+            return 0
+        target = self.count*percent/100
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
+
+def format_histogram(name, labels, histogram):
+    lines = []
+    seen = 0
+    for bound, count in zip(histogram.BOUNDS, histogram.buckets):
+        seen += count
+        lines.append('%s_bucket%s %d' % (
+            name, format_labels(dict(labels, le='%g' % bound)), seen))
+    lines.append('%s_bucket%s %d' % (
+        name, format_labels(dict(labels, le='+Inf')), histogram.count))
+    lines.append('%s_sum%s %r' % (
+        name, format_labels(labels), float(histogram.total)))
+    lines.append('%s_count%s %d' % (
+        name, format_labels(labels), histogram.count))
+    return lines
+
+class Registry:
+    '''Gathers metrics from a set of collectors (functions that yield
+    Metrics) and renders them in the Prometheus text format'''
+
+    def __init__(self):
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            self.collectors.remove(collector)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            yield from collector()
+
+    def render(self):
+        # Samples with the same name have to be grouped together, under a
+        # single HELP/TYPE header, even when they come from different
+        # collectors (eg one per cabinet)
+        families = {}
+        for metric in self.collect():
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in families.items():
+            lines.append('# HELP %s %s' % (name, metrics[0].help))
+            lines.append('# TYPE %s %s' % (name, metrics[0].type))
+            for metric in metrics:
+                if metric.type == HISTOGRAM:
+                    lines.extend(format_histogram(
+                        name, metric.labels, metric.value))
+                else:
+                    lines.append('%s%s %r' % (
+                        name, format_labels(metric.labels),
+                        float(metric.value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+async def handle_scrape(registry, reader, writer):
+    '''Answers a single HTTP request with the current metrics'''
+    import asyncio
+
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers, we don't need any of them
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and (
+                parts[1] in (b'/', b'/metrics')):
+            status = '200 OK'
+            body = registry.render().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'not found\n'
+
+        writer.write((
+            'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+            'Connection: close\r\n\r\n' % (
+                status, CONTENT_TYPE, len(body))).encode('ascii') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(registry, address):
+    '''Serves the registry over HTTP on the given address, which is either
+    "[host]:port" (host defaults to localhost) or the path of a Unix socket.
+    Returns the asyncio server.'''
+    # Imported here since asyncio is slow to load, and the watcher takes its
+    # first sample before it needs it
+    import asyncio
+
+    def handler(reader, writer):
+        return handle_scrape(registry, reader, writer)
+
+    if os.sep in address:
+        if os.path.exists(address):
+            # Left over from a previous run
+            os.unlink(address)
+        return await asyncio.start_unix_server(handler, address)
+
+    host, sep, port = address.rpartition(':')
+    return await asyncio.start_server(
+        handler, host or 'localhost', int(port))
@@ -0,0 +1,204 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from collections import namedtuple
+
+from . import tetris
+
+# Summary of the play area, measured in cells. Heights count up from the
+# bottom of the play area, so an empty column has height zero.
+BoardStats = namedtuple(
+    'BoardStats', ('heights', 'max_height', 'holes', 'bumpiness',
+                   'well_depth', 'completed_rows'))
+
+# The walls on either side of the play area act like infinitely tall columns
+# when measuring wells
+WALL_HEIGHT = np.array([tetris.PLAY_AREA_ROWS])
+
+def get_occupied(area):
+    """Returns a boolean (rows x cols) array marking the non-empty cells
+    of the given play area (see tetris.get_play_area)"""
+    return area != tetris.PLAY_AREA_EMPTY
+
+def get_column_heights(occupied):
+    rows = occupied.shape[0]
+    # argmax finds the first (ie highest) occupied cell in each column
+    top = occupied.argmax(axis=0)
+    return np.where(occupied.any(axis=0), rows-top, 0)
+
+def count_holes(occupied):
+    """Counts the empty cells that have something above them"""
+    covered = np.logical_or.accumulate(occupied, axis=0)
+    return int(np.count_nonzero(covered & ~occupied))
+
+def get_bumpiness(heights):
+    """Sum of the height differences between neighbouring columns"""
+    return int(np.abs(np.diff(heights)).sum())
+
+def get_well_depth(heights):
+    """Returns the depth of the deepest well, ie a column lower than both
+    its neighbours (or the wall)"""
+    padded = np.concatenate((WALL_HEIGHT, heights, WALL_HEIGHT))
+    depths = np.minimum(padded[:-2], padded[2:]) - heights
+    return max(0, int(depths.max()))
+
+def get_completed_rows(occupied):
+    """Returns the indices (from the top) of completely filled rows"""
+    return tuple(int(row) for row in np.flatnonzero(occupied.all(axis=1)))
+
+def analyze(area):
+    occupied = get_occupied(area)
+    heights = get_column_heights(occupied)
+    return BoardStats(
+        heights=tuple(int(height) for height in heights),
+        max_height=int(heights.max()),
+        holes=count_holes(occupied),
+        bumpiness=get_bumpiness(heights),
+        well_depth=get_well_depth(heights),
+        completed_rows=get_completed_rows(occupied))
+
+#
+# A packed board holds just which cells are occupied, as a 200 bit integer
+# (bit row*cols + col, with row 0 at the top), so boards are cheap to keep,
+# compare and hash. Optionally it also keeps the colour of each cell, as two
+# bits per cell.
+#
+
+CELLS = tetris.PLAY_AREA_ROWS * tetris.PLAY_AREA_COLS
+PACKED_SIZE = (CELLS + 7) // 8
+COLOURS_SIZE = (CELLS*2 + 7) // 8
+
+# Colour codes for the tiles (anything else that isn't empty is 0)
+TILE_COLOURS = np.zeros(256, dtype=np.uint8)
+TILE_COLOURS[tetris.PLAY_AREA_WHITE] = 1
+TILE_COLOURS[tetris.PLAY_AREA_CYAN] = 2
+TILE_COLOURS[tetris.PLAY_AREA_BLUE] = 3
+
+# The first bit of every row
+ROW_STARTS = sum(
+    1 << (row*tetris.PLAY_AREA_COLS) for row in range(tetris.PLAY_AREA_ROWS))
+
+class PackedBoard:
+    """Occupancy (and optionally colours) of the play area, packed into a
+    200 bit integer. Boards are immutable, so they can be hashed (eg to
+    find repeated positions) and compared in constant time."""
+
+    __slots__ = ('bits', 'colours')
+
+    def __init__(self, bits, colours=None):
+        self.bits = bits
+        self.colours = colours
+
+    @classmethod
+    def from_area(cls, area, colours=False):
+        """Packs the given play area (see tetris.get_play_area)"""
+        occupied = get_occupied(area).ravel()
+        bits = int.from_bytes(
+            np.packbits(occupied, bitorder='little').tobytes(), 'little')
+        packed_colours = None
+        if colours:
+            codes = TILE_COLOURS[area.ravel()].reshape(-1, 4)
+            packed_colours = (
+                codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) |
+                (codes[:, 3] << 6)).tobytes()
+        return cls(bits, packed_colours)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """The reverse of to_bytes"""
+        if len(data) not in (PACKED_SIZE, PACKED_SIZE + COLOURS_SIZE):
+            raise ValueError(
+                'packed board should be %d or %d bytes, not %d' % (
+                    PACKED_SIZE, PACKED_SIZE + COLOURS_SIZE, len(data)))
+        bits = int.from_bytes(data[:PACKED_SIZE], 'little')
+        colours = bytes(data[PACKED_SIZE:]) or None
+        return cls(bits, colours)
+
+    def to_bytes(self):
+        """Returns the board as 25 bytes (or 75 with colours)"""
+        data = self.bits.to_bytes(PACKED_SIZE, 'little')
+        if self.colours:
+            data += self.colours
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedBoard):
+            return NotImplemented
+        return self.bits == other.bits and self.colours == other.colours
+
+    def __hash__(self):
+        return hash((self.bits, self.colours))
+
+    def __repr__(self):
+        return 'PackedBoard(%#x)' % self.bits
+
+    def is_occupied(self, row, col):
+        return bool(self.bits >> (row*tetris.PLAY_AREA_COLS + col) & 1)
+
+    def get_colour(self, row, col):
+        """Returns the colour code (see TILE_COLOURS) of a cell, or None if
+        the board doesn't have colours"""
+        if not self.colours:
+            return None
+        cell = row*tetris.PLAY_AREA_COLS + col
+        return (self.colours[cell // 4] >> (2*(cell % 4))) & 3
+
+    def count(self):
+        """Returns the number of occupied cells"""
+        return bin(self.bits).count('1')
+
+    def get_occupied(self):
+        """Unpacks the occupancy into a boolean (rows x cols) array"""
+        data = np.frombuffer(
+            self.bits.to_bytes(PACKED_SIZE, 'little'), dtype=np.uint8)
+        occupied = np.unpackbits(data, count=CELLS, bitorder='little')
+        return occupied.astype(bool).reshape(
+            (tetris.PLAY_AREA_ROWS, tetris.PLAY_AREA_COLS))
+
+    def get_full_rows_mask(self):
+        """Returns a mask with the first bit of every full row set"""
+        # A row is full when all of its bits are set, so AND each cell with
+        # the ones to its right and look at the first cell of each row
+        mask = self.bits
+        for shift in range(1, tetris.PLAY_AREA_COLS):
+            mask &= self.bits >> shift
+        return mask & ROW_STARTS
+
+    def get_full_rows(self):
+        """Returns the indices (from the top) of completely filled rows"""
+        return mask_to_rows(self.get_full_rows_mask())
+
+    def get_cleared_rows(self, previous):
+        """Returns the rows that were full on the previous board but aren't
+        on this one, ie the rows the game has just cleared. (the game shows
+        full rows for several frames before clearing them, so comparing
+        consecutive samples will catch them)"""
+        return mask_to_rows(
+            previous.get_full_rows_mask() & ~self.get_full_rows_mask())
+
+def mask_to_rows(mask):
+    rows = []
+    row = 0
+    while mask:
+        if mask & 1:
+            rows.append(row)
+        mask >>= tetris.PLAY_AREA_COLS
+        row += 1
+    return tuple(rows)
+
+def pack(area, colours=False):
+    return PackedBoard.from_area(area, colours)
@@ -15,29 +15,86 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import mmap
-import psutil
+import glob
 import re
 import os
 
+from .ram import Ram
+
 DEFAULT_SHM_PATH = '/dev/shm/fceu-shm'
 
 def open_shm(path=DEFAULT_SHM_PATH):
     with open(path, 'r+b') as file:
         return mmap.mmap(file.fileno(), 0)
 
+def open_ram(path=DEFAULT_SHM_PATH):
+    """Like open_shm, but wraps the memory in a (zero-copy) Ram object"""
+    with open(path, 'r+b') as file:
+        return Ram(
+            mmap.mmap(file.fileno(), 0), inode=os.fstat(file.fileno()).st_ino)
+
 def is_shm_available(path=DEFAULT_SHM_PATH):
     return os.path.exists(path)
 
+def find_shm_paths(patterns):
+    """Expands a list of shm paths and/or glob patterns (eg
+    '/dev/shm/fceu-shm-*') into a sorted list of segment paths. Plain paths
+    are always returned, even if the segment doesn't exist yet."""
+    paths = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.update(glob.glob(pattern))
+        else:
+            paths.add(pattern)
+    return sorted(paths)
+
+# Patterns matched against the emulator's command line to guess the game
+ROM_PATTERNS = (
+    ('tetris', re.compile('.*tetris.*nes')),
+)
+
+# The emulator process we found last time
+cached_proc = None
+
 def get_proc():
+    """Returns the retroarch process. Finding it means scanning every process
+    on the box, so we hang on to it for as long as it's running."""
+    global cached_proc
+    if cached_proc and cached_proc.is_running():
+        return cached_proc
+
+    # psutil takes a while to import, and we usually don't need it at all
+    # (see romid) so only load it when we do
+    import psutil
+
+    cached_proc = None
     for proc in psutil.process_iter():
-        if 'retroarch' in proc.name().lower():
-            return proc
+        try:
+            if 'retroarch' in proc.name().lower():
+                cached_proc = proc
+                break
+        except psutil.Error:
+            # Exited (or isn't ours to look at) while we were scanning
+            continue
+    return cached_proc
+
+def get_running_game():
+    """Makes a guess at which game the emulator is running based on its
+    command line, returning the game ID (or None)"""
+    proc = get_proc()
+    if not proc:
+        return None
+    try:
+        cmdline = proc.cmdline()
+    except Exception:
+        # Most likely a psutil.Error (eg the emulator just exited)
+        return None
+    for game_id, pattern in ROM_PATTERNS:
+        if any(pattern.match(arg.lower()) for arg in cmdline):
+            return game_id
     return None
 
 def is_tetris_running():
     """Make a reasonable guess as to whether tetris is being played"""
-    # TODO - a bit of a hack
-    proc = get_proc()
-    return proc and any(
-        re.match('.*tetris.*nes', arg.lower()) for arg in proc.cmdline())
-
+    # TODO - a bit of a hack (prefer romid.identify, which checks the RAM)
+    return get_running_game() == 'tetris'
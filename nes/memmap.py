@@ -0,0 +1,200 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Declarative memory maps. Each game has a JSON file under 'maps/' that
+# describes where things live in its RAM:
+#
+#   signature: bytes the game always writes at some address (see romid)
+#   charmaps: strings mapping byte values to characters, for text fields
+#   fields: name -> {address, type, size, count, stride, charmap, shape}
+#
+# Field types are u8, u16 (little-endian), bcd and bcd-le (BCD numbers of
+# 'size' bytes, big or little-endian), text (decoded through a charmap) and
+# array (raw bytes, with an optional shape). A field with a count is
+# repeated that many times, 'stride' bytes apart (defaulting to its size),
+# and decodes to a tuple.
+#
+# A set of fields is compiled into a DecodePlan, which reads all of them
+# with a single struct.unpack_from call before converting the values.
+#
+
+import json
+import os
+import struct
+from collections import namedtuple
+
+from .ram import as_view
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps')
+
+Field = namedtuple(
+    'Field', ('name', 'type', 'address', 'size', 'count', 'stride',
+              'charmap', 'shape'))
+
+# Size of each field type in bytes (None means it comes from the map)
+TYPE_SIZES = {
+    'u8' : 1,
+    'u16' : 2,
+    'bcd' : None,
+    'bcd-le' : None,
+    'text' : None,
+    'array' : None,
+}
+
+# Maps a BCD encoded byte to its value (0-99), or None if it isn't valid BCD
+BCD_TABLE = tuple(
+    (n >> 4)*10 + (n & 0xf) if (n >> 4) < 10 and (n & 0xf) < 10 else None
+    for n in range(256))
+
+class MemoryMapError(Exception):
+    pass
+
+def parse_int(value):
+    if isinstance(value, str):
+        return int(value, 0)
+    return value
+
+def decode_bcd(data):
+    '''Decodes big-endian BCD bytes, returning None if they aren't valid'''
+    value = 0
+    for byte in data:
+        digits = BCD_TABLE[byte]
+        if digits is None:
+            return None
+        value = value*100 + digits
+    return value
+
+def make_charmap_table(chars):
+    '''Returns a bytes.translate table for the given charmap. Bytes past
+    the end of the charmap decode as spaces.'''
+    return bytes(
+        ord(chars[n]) if n < len(chars) else ord(' ') for n in range(256))
+
+class MemoryMap:
+    def __init__(self, spec):
+        self.game = spec['game']
+        self.charmaps = dict(spec.get('charmaps', {}))
+        self.charmap_tables = {
+            name : make_charmap_table(chars)
+            for name, chars in self.charmaps.items()
+        }
+
+        signature = spec.get('signature')
+        if signature:
+            self.signature_address = parse_int(signature['address'])
+            self.signature = bytes.fromhex(signature['bytes'])
+        else:
+            self.signature_address = None
+            self.signature = None
+
+        self.fields = {}
+        for name, info in spec['fields'].items():
+            kind = info['type']
+            if kind not in TYPE_SIZES:
+                raise MemoryMapError('%s: unknown type %s' % (name, kind))
+            size = TYPE_SIZES[kind] or parse_int(info['size'])
+            if kind == 'text' and info.get('charmap') not in self.charmaps:
+                raise MemoryMapError('%s: unknown charmap' % name)
+            self.fields[name] = Field(
+                name, kind, parse_int(info['address']), size,
+                parse_int(info.get('count', 1)),
+                parse_int(info.get('stride', size)),
+                info.get('charmap'),
+                tuple(info['shape']) if 'shape' in info else None)
+
+    def get_address(self, name, index=0):
+        field = self.fields[name]
+        return field.address + index*field.stride
+
+    def get_range(self, names):
+        '''Returns the (first, last) address covered by the given fields'''
+        fields = [self.fields[name] for name in names]
+        return (
+            min(field.address for field in fields),
+            max(field.address + (field.count-1)*field.stride + field.size - 1
+                for field in fields))
+
+    def compile(self, names=None):
+        '''Returns a DecodePlan for the given fields (or all of them)'''
+        if names is None:
+            names = list(self.fields)
+        return DecodePlan(self, [self.fields[name] for name in names])
+
+class DecodePlan:
+    '''Decodes a fixed set of fields from RAM in one pass. The values come
+    back as a namedtuple with an attribute per field.'''
+
+    def __init__(self, memory_map, fields):
+        items = sorted(
+            (field.address + n*field.stride, n, field)
+            for field in fields for n in range(field.count))
+
+        self.start = items[0][0]
+        fmt = ['<']
+        pos = self.start
+        self.converters = []
+        for address, n, field in items:
+            if address < pos:
+                raise MemoryMapError('%s overlaps another field' % field.name)
+            if address > pos:
+                fmt.append('%dx' % (address-pos))
+
+            if field.type == 'u8':
+                fmt.append('B')
+            elif field.type == 'u16':
+                fmt.append('H')
+            else:
+                fmt.append('%ds' % field.size)
+            pos = address + field.size
+            self.converters.append(
+                (field.name, n, self.get_converter(memory_map, field)))
+
+        self.struct = struct.Struct(''.join(fmt))
+        self.fields = fields
+        self.Result = namedtuple(
+            'Decoded', [field.name for field in fields])
+
+    def get_converter(self, memory_map, field):
+        if field.type == 'bcd':
+            return decode_bcd
+        if field.type == 'bcd-le':
+            return lambda data: decode_bcd(reversed(data))
+        if field.type == 'text':
+            table = memory_map.charmap_tables[field.charmap]
+            return lambda data: data.translate(table).decode('ascii')
+        return None
+
+    def decode(self, ram, base=0):
+        '''Decodes the fields from the given RAM. If the RAM is just part
+        of the full memory, 'base' is the address it starts at.'''
+        raw = self.struct.unpack_from(as_view(ram), self.start-base)
+
+        values = {}
+        for value, (name, n, convert) in zip(raw, self.converters):
+            if convert:
+                value = convert(value)
+            values.setdefault(name, []).append(value)
+
+        return self.Result(*(
+            values[field.name][0] if field.count == 1
+            else tuple(values[field.name])
+            for field in self.fields))
+
+def load(game_id):
+    '''Loads the memory map for the given game'''
+    with open(os.path.join(MAPS_DIR, game_id + '.json')) as file:
+        return MemoryMap(json.load(file))
@@ -0,0 +1,81 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+
+class Ram:
+    """Zero-copy access to a block of NES RAM (usually the emulator's shared
+    memory). Indexing works like the underlying buffer, except that slices
+    are memoryviews into the RAM rather than copies. Note that views are
+    live: they change as the emulator writes to memory.
+
+    If the RAM came from a file, 'inode' identifies which one, so we can
+    tell when the file has been replaced."""
+
+    def __init__(self, buf, inode=None):
+        self.buf = buf
+        self.inode = inode
+        self.view = memoryview(buf)
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, key):
+        return self.view[key]
+
+    def __setitem__(self, key, value):
+        self.view[key] = value
+
+    @functools.cached_property
+    def array(self):
+        # Made on first use, so we don't have to load numpy until something
+        # actually needs it (it's slow to import)
+        import numpy as np
+        return np.frombuffer(self.buf, dtype=np.uint8)
+
+    def get_view(self, start, size):
+        return self.view[start:start+size]
+
+    def get_array(self, start, size, shape=None):
+        array = self.array[start:start+size]
+        if shape:
+            array = array.reshape(shape)
+        return array
+
+    def copy(self):
+        """Returns a snapshot of the entire RAM as bytes"""
+        return self.view.tobytes()
+
+    def release(self):
+        """Drops our views of the buffer. (an mmap can't be closed while
+        there are views into it)"""
+        self.view.release()
+        self.view = None
+        self.array = None
+
+def as_view(ram):
+    """Returns a memoryview of the given RAM, which can be a Ram or anything
+    else supporting the buffer protocol (bytes, mmap, etc)"""
+    if isinstance(ram, Ram):
+        return ram.view
+    return memoryview(ram)
+
+def as_array(ram):
+    """Returns a uint8 array view of the given RAM (see as_view)"""
+    if isinstance(ram, Ram):
+        return ram.array
+    import numpy as np
+    return np.frombuffer(ram, dtype=np.uint8)
@@ -0,0 +1,251 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Recordings of NES RAM, one frame after another. The file layout is:
+#
+#   header: magic, frame size
+#   records: kind, timestamp, payload size, payload
+#   index: (frame number, file offset, timestamp) for every keyframe
+#   footer: index offset, keyframe count, frame count, magic
+#
+# A keyframe's payload is the zlib compressed frame. Every other frame is
+# stored as the zlib compressed XOR against the previous frame, which is
+# almost all zeros. (an unchanged frame has an empty payload) Keyframes are
+# written periodically so we can seek without decoding from the start, and
+# the index lets us find them. If the recorder dies before writing the
+# index, the reader rebuilds it by scanning the records.
+#
+
+import bisect
+import struct
+import time
+import zlib
+
+from .ram import as_view
+
+HEADER = struct.Struct('<8sI')
+HEADER_MAGIC = b'NESREC1\0'
+
+RECORD = struct.Struct('<BdI')
+KEYFRAME = 0
+DELTA = 1
+
+INDEX_ENTRY = struct.Struct('<IQd')
+FOOTER = struct.Struct('<QII8s')
+FOOTER_MAGIC = b'NESIDX1\0'
+
+# Write a keyframe every ~10 seconds of play
+KEYFRAME_INTERVAL = 600
+
+# Deltas are mostly zeros so the fastest compression level does nearly as
+# well as the default, at a fraction of the cost
+COMPRESS_LEVEL = 1
+
+class RecordingError(Exception):
+    pass
+
+def xor_bytes(a, b):
+    size = len(a)
+    return (int.from_bytes(a, 'little') ^
+            int.from_bytes(b, 'little')).to_bytes(size, 'little')
+
+class RecordingWriter:
+    """Writes a stream of RAM frames to a recording file"""
+
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL,
+                 clock=time.monotonic):
+        self.file = open(path, 'wb')
+        self.keyframe_interval = keyframe_interval
+        self.clock = clock
+        self.frame_size = None
+        self.frame_count = 0
+        self.last_frame = None
+        self.start_time = None
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, frame, timestamp=None):
+        """Adds a frame (anything supporting the buffer protocol) to the
+        recording. The timestamp defaults to now."""
+        if timestamp is None:
+            timestamp = self.clock()
+
+        frame = bytes(frame)
+        if self.frame_size is None:
+            self.frame_size = len(frame)
+            self.start_time = timestamp
+            self.file.write(HEADER.pack(HEADER_MAGIC, self.frame_size))
+
+        elif len(frame) != self.frame_size:
+            raise RecordingError('frame size changed from %d to %d' % (
+                self.frame_size, len(frame)))
+
+        timestamp -= self.start_time
+        if self.frame_count % self.keyframe_interval == 0:
+            self.index.append((self.frame_count, self.file.tell(), timestamp))
+            kind = KEYFRAME
+            payload = zlib.compress(frame, COMPRESS_LEVEL)
+
+        elif frame == self.last_frame:
+            kind = DELTA
+            payload = b''
+
+        else:
+            kind = DELTA
+            payload = zlib.compress(
+                xor_bytes(frame, self.last_frame), COMPRESS_LEVEL)
+
+        self.file.write(RECORD.pack(kind, timestamp, len(payload)))
+        self.file.write(payload)
+        self.last_frame = frame
+        self.frame_count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(FOOTER.pack(
+            index_offset, len(self.index), self.frame_count, FOOTER_MAGIC))
+        self.file.close()
+
+class RecordingReader:
+    """Reads back the frames of a recording. Iterating gives (timestamp,
+    frame) pairs, where timestamps are in seconds from the first frame."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            self.file.close()
+            raise RecordingError('%s is too short to be a recording' % path)
+        magic, self.frame_size = HEADER.unpack(header)
+        if magic != HEADER_MAGIC:
+            self.file.close()
+            raise RecordingError('%s is not a recording' % path)
+
+        if not self.read_index():
+            self.scan_index()
+        self.keyframe_numbers = [entry[0] for entry in self.index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.frame_count
+
+    def __iter__(self):
+        return self.frames()
+
+    def close(self):
+        self.file.close()
+
+    def read_index(self):
+        self.file.seek(0, 2)
+        file_size = self.file.tell()
+        if file_size < HEADER.size + FOOTER.size:
+            return False
+
+        self.file.seek(file_size-FOOTER.size)
+        index_offset, count, self.frame_count, magic = FOOTER.unpack(
+            self.file.read(FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            return False
+
+        self.records_end = index_offset
+        self.file.seek(index_offset)
+        data = self.file.read(count*INDEX_ENTRY.size)
+        self.index = list(INDEX_ENTRY.iter_unpack(data))
+        return True
+
+    def scan_index(self):
+        """Rebuilds the index from the records themselves (eg the recorder
+        was killed before it could write one)"""
+        self.index = []
+        self.frame_count = 0
+        offset = HEADER.size
+        self.file.seek(offset)
+        while True:
+            data = self.file.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            kind, timestamp, size = RECORD.unpack(data)
+            payload = self.file.read(size)
+            if len(payload) < size:
+                # Truncated mid-record
+                break
+            if kind == KEYFRAME:
+                self.index.append((self.frame_count, offset, timestamp))
+            offset += RECORD.size + size
+            self.frame_count += 1
+        self.records_end = offset
+
+    def frames(self, start=0):
+        """Yields (timestamp, frame) from the given frame number onwards.
+        This seeks to the nearest keyframe first, so it's cheap to start
+        part way through a recording."""
+        if not self.index or start >= self.frame_count:
+            return
+
+        pos = bisect.bisect_right(self.keyframe_numbers, start) - 1
+        frame_number, offset, _ = self.index[max(pos, 0)]
+        self.file.seek(offset)
+
+        frame = None
+        while frame_number < self.frame_count:
+            kind, timestamp, size = RECORD.unpack(
+                self.file.read(RECORD.size))
+            payload = self.file.read(size)
+
+            if kind == KEYFRAME:
+                frame = zlib.decompress(payload)
+            elif payload:
+                frame = xor_bytes(frame, zlib.decompress(payload))
+
+            if frame_number >= start:
+                yield timestamp, frame
+            frame_number += 1
+
+def replay(reader, ram, on_frame, start=0, speed=None, sleep=time.sleep):
+    """Plays a recording back into the given (writable) RAM buffer, calling
+    on_frame() after each frame is loaded. With no speed given frames are
+    played back as fast as possible, otherwise at the given multiple of
+    real time."""
+    view = as_view(ram)
+    start_time = time.monotonic()
+    first_timestamp = None
+    for timestamp, frame in reader.frames(start):
+        if first_timestamp is None:
+            first_timestamp = timestamp
+
+        if speed:
+            delay = ((timestamp-first_timestamp)/speed -
+                     (time.monotonic()-start_time))
+            if delay > 0:
+                sleep(delay)
+
+        view[:] = frame
+        on_frame()
@@ -0,0 +1,59 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+Region = namedtuple('Region', ('name', 'start', 'size'))
+
+class RegionWatcher:
+    """Keeps a copy of a few interesting regions of NES ram, so callers can
+    tell cheaply whether anything in them has changed since last time.
+    Each region has a version number that goes up whenever its contents
+    change."""
+
+    def __init__(self, ram, regions):
+        self.ram = ram
+        self.slices = {}
+        self.last = {}
+        self.versions = {}
+        self.reported = {}
+        for region in regions:
+            self.slices[region.name] = slice(
+                region.start, region.start+region.size)
+            self.last[region.name] = None
+            self.versions[region.name] = 0
+            self.reported[region.name] = 0
+
+    def refresh(self, name):
+        """Checks a single region for changes and returns its version"""
+        # With a Ram object this compares a view of the memory directly, so
+        # we only pay for a copy when something actually changed
+        data = self.ram[self.slices[name]]
+        if data != self.last[name]:
+            self.last[name] = bytes(data)
+            self.versions[name] += 1
+        return self.versions[name]
+
+    def update(self):
+        """Checks every region, returning the names of those that changed
+        since the last call to update()"""
+        changed = set()
+        for name in self.slices:
+            version = self.refresh(name)
+            if version != self.reported[name]:
+                self.reported[name] = version
+                changed.add(name)
+        return changed
@@ -0,0 +1,43 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Works out which game is running by looking for signature bytes in its RAM,
+# and maps the resulting game ID onto the module that knows how to decode
+# that game's memory.
+#
+
+from .ram import as_view
+from . import tetris
+
+# Game ID -> module with SIGNATURE_START and SIGNATURE
+GAMES = {
+    'tetris' : tetris,
+}
+
+def identify(ram):
+    """Returns the ID of the game that the RAM belongs to, or None if it
+    isn't recognized (including when the game hasn't initialized it yet)"""
+    view = as_view(ram)
+    for game_id, module in GAMES.items():
+        start = module.SIGNATURE_START
+        if view[start:start+len(module.SIGNATURE)] == module.SIGNATURE:
+            return game_id
+    return None
+
+def get_decoder(game_id):
+    """Returns the module used to decode the given game's RAM"""
+    return GAMES[game_id]
@@ -0,0 +1,150 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Searches NES RAM for the addresses that hold some value of interest (a
+# score, a piece counter, ...) by comparing successive frames and narrowing
+# down the candidates that behave the way the value should.
+#
+
+import numpy as np
+
+from .memmap import BCD_TABLE
+from .ram import as_array
+
+# How the value at each address is read: a byte, a little-endian 16-bit
+# word, or a BCD number stored big or little-endian (over 'width' bytes)
+ENCODINGS = ('u8', 'u16', 'bcd', 'bcd-le')
+
+# Comparisons between the old and new value at each address
+CHANGED = 'changed'
+SAME = 'same'
+EQUALS = 'equals'
+INCREASED = 'increased'
+DECREASED = 'decreased'
+DELTA = 'delta'
+
+# BCD byte -> value (0-99), or -1 if it isn't valid BCD
+BCD_VALUES = np.array(
+    [-1 if value is None else value for value in BCD_TABLE], dtype=np.int64)
+
+def get_width(encoding, width=1):
+    if encoding == 'u8':
+        return 1
+    if encoding == 'u16':
+        return 2
+    return width
+
+def combine(windows, encoding):
+    """Decodes an array of byte windows (the last axis holding the bytes of
+    each value) into int64 values, with -1 marking invalid values"""
+    windows = windows.astype(np.int64)
+    if encoding == 'u8':
+        return windows[..., 0]
+    if encoding == 'u16':
+        return windows[..., 0] | (windows[..., 1] << 8)
+
+    digits = BCD_VALUES[windows]
+    powers = 100 ** np.arange(windows.shape[-1], dtype=np.int64)
+    if encoding == 'bcd':
+        powers = powers[::-1]
+    values = (digits * powers).sum(axis=-1)
+    return np.where((digits >= 0).all(axis=-1), values, -1)
+
+def decode_values(frame, encoding='u8', width=1):
+    """Returns the value starting at every address of the frame. Addresses
+    too close to the end to hold a whole value are -1 (invalid)."""
+    data = as_array(frame)
+    width = get_width(encoding, width)
+    values = np.full(len(data), -1, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(data, width)
+    values[:len(windows)] = combine(windows, encoding)
+    return values
+
+def compare(old, new, op, value=None):
+    """Returns a mask of the addresses where the old and new values compare
+    as given by 'op'"""
+    valid = (old >= 0) & (new >= 0)
+    if op == CHANGED:
+        match = new != old
+    elif op == SAME:
+        match = new == old
+    elif op == EQUALS:
+        match = new == value
+    elif op == INCREASED:
+        match = new > old
+    elif op == DECREASED:
+        match = new < old
+    elif op == DELTA:
+        match = (new - old) == value
+    else:
+        raise ValueError('unknown comparison: %s' % op)
+    return valid & match
+
+class MemorySearch:
+    """Keeps track of the addresses that are still candidates, and the raw
+    frames seen so far (as rows of a 2-D uint8 array)"""
+
+    def __init__(self, frame, encoding='u8', width=1):
+        if encoding not in ENCODINGS:
+            raise ValueError('unknown encoding: %s' % encoding)
+        self.encoding = encoding
+        self.width = get_width(encoding, width)
+
+        data = as_array(frame)
+        self.history = np.empty((16, len(data)), dtype=np.uint8)
+        self.steps = 0
+        self.add_history(data)
+
+        self.values = decode_values(data, encoding, self.width)
+        self.candidates = self.values >= 0
+
+    def add_history(self, data):
+        if self.steps == len(self.history):
+            # Out of room, so double it
+            self.history = np.concatenate(
+                (self.history, np.empty_like(self.history)))
+        self.history[self.steps] = data
+        self.steps += 1
+
+    def step(self, frame, op, value=None):
+        """Filters the candidates against a new frame, returning how many
+        are left"""
+        data = as_array(frame)
+        values = decode_values(data, self.encoding, self.width)
+        self.candidates &= compare(self.values, values, op, value)
+        self.values = values
+        self.add_history(data)
+        return self.get_count()
+
+    def run(self, frames, op, value=None):
+        """Applies the same filter over a whole series of frames"""
+        for frame in frames:
+            self.step(frame, op, value)
+        return self.get_count()
+
+    def get_count(self):
+        return int(np.count_nonzero(self.candidates))
+
+    def get_addresses(self):
+        return np.flatnonzero(self.candidates)
+
+    def get_history(self, addr):
+        """Returns the value at the given address in every frame so far"""
+        if addr+self.width > self.history.shape[1]:
+            return np.full(self.steps, -1, dtype=np.int64)
+        windows = self.history[:self.steps, addr:addr+self.width]
+        return combine(windows, self.encoding)
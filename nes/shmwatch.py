@@ -0,0 +1,139 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Watches for shm segments coming and going using inotify (Linux only), so
+# we hear about the emulator creating or recreating its segment as soon as
+# it happens instead of polling for it.
+#
+
+import ctypes
+import os
+import struct
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+# struct inotify_event (followed by 'len' bytes of name)
+EVENT = struct.Struct('iIII')
+
+# Kinds of event reported by ShmWatcher
+CREATED = 'create'
+DELETED = 'delete'
+REPLACED = 'replace'
+# Events were lost, so anything could have changed
+OVERFLOW = 'overflow'
+
+libc = None
+
+def get_libc():
+    global libc
+    if libc is None:
+        # The process already has libc loaded, so look in there rather than
+        # searching for it (find_library runs ldconfig, which is slow)
+        libc = ctypes.CDLL(None, use_errno=True)
+    return libc
+
+def is_supported():
+    try:
+        return hasattr(get_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+def get_inode(path):
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+class ShmWatcher:
+    '''Reports shm segments being created, deleted or replaced (a new
+    segment created in place of one we already knew about) in the watched
+    directories. Use fileno() with select or an event loop to find out when
+    there are events to read.'''
+
+    def __init__(self, directories=('/dev/shm',)):
+        if not is_supported():
+            raise OSError('inotify is not supported here')
+        self.fd = get_libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.directories = {}
+        self.inodes = {}
+        for directory in directories:
+            self.add_directory(directory)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_directory(self, directory):
+        if directory in self.directories.values():
+            return
+        wd = get_libc().inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+        # Remember what's there already, so we can spot replacements
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            self.inodes[path] = get_inode(path)
+
+    def read_events(self):
+        '''Returns a list of (kind, path) for everything that has happened
+        since last time. Doesn't block.'''
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset+size].rstrip(b'\0')
+            offset += size
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((OVERFLOW, None))
+                continue
+
+            path = os.path.join(self.directories[wd], os.fsdecode(name))
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                inode = get_inode(path)
+                if self.inodes.get(path) is not None:
+                    kind = REPLACED
+                else:
+                    kind = CREATED
+                self.inodes[path] = inode
+                events.append((kind, path))
+
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.inodes[path] = None
+                events.append((DELETED, path))
+        return events
@@ -0,0 +1,76 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# The emulator keeps writing to its RAM while we read it, so a value that
+# spans several bytes (a BCD score, a name in the high-score table) can be
+# read half from one frame and half from the next. FrameCapture copies the
+# RAM into a buffer of our own and checks that the copy is consistent before
+# anything gets decoded from it.
+#
+
+from .ram import Ram, as_view
+
+class FrameCapture:
+    """Captures consistent copies (frames) of a block of NES RAM.
+
+    Each capture copies the whole RAM (it's only 2k) into the same buffer,
+    then checks that nothing moved under us: the given regions are read
+    again and compared with the copy, and if the game has a frame counter we
+    also check that it didn't tick over during the copy. If the check fails
+    the capture is retried, a few times at most, after which we settle for
+    the last copy and count it as torn.
+
+    The frame is a Ram over our buffer, so it can be passed to any of the
+    decoders. It's overwritten by the next capture (copy it to keep it)."""
+
+    MAX_RETRIES = 3
+
+    def __init__(self, ram, regions, counter=None, max_retries=MAX_RETRIES):
+        self.live = as_view(ram)
+        self.frame = Ram(bytearray(len(self.live)))
+        self.view = self.frame.view
+        self.max_retries = max_retries
+        self.captures = 0
+        self.retries = 0
+        self.torn = 0
+
+        # Set up the views we compare up front, since making them is most
+        # of the cost of a check
+        self.counter = None
+        if counter:
+            self.counter = self.live[counter.start:counter.start+counter.size]
+            self.last_counter = bytearray(counter.size)
+        self.checks = tuple(
+            (self.live[region.start:region.start+region.size],
+             self.view[region.start:region.start+region.size])
+            for region in regions)
+
+    def capture(self):
+        """Takes a new frame and returns it"""
+        self.captures += 1
+        for attempt in range(self.max_retries+1):
+            if self.counter:
+                self.last_counter[:] = self.counter
+            self.view[:] = self.live
+
+            if (all(live == copy for live, copy in self.checks) and
+                    (not self.counter or self.counter == self.last_counter)):
+                return self.frame
+            self.retries += 1
+
+        self.torn += 1
+        return self.frame
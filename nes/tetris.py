@@ -14,32 +14,40 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from . import fceu
+from . import memmap
+from .memmap import decode_bcd
+from .ram import as_array, as_view
+from .regions import Region
 from collections import namedtuple
+import functools
 
-LETTER_MAP = '-ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789,/()\". '
+# Where everything lives in RAM (see maps/tetris.json)
+MEMORY_MAP = memmap.load('tetris')
 
-def byte_to_char(ch):
-    try:
-        return LETTER_MAP[ch]
-    except IndexError:
-        return ' '
+LETTER_MAP = MEMORY_MAP.charmaps['letters']
+
+# Translation table for decoding names (see bytes.translate)
+NAME_TABLE = MEMORY_MAP.charmap_tables['letters']
+
+def decode_name(data):
+    return bytes(data).translate(NAME_TABLE).decode('ascii')
 
 # TODO - this is a bit ugly
 HighScoreEntry = namedtuple(
     'HighScoreEntry', ('rank', 'game_type', 'name', 'score', 'level'))
 
-HIGH_SCORES_A = (
-    HighScoreEntry(1, 'A', 0x700, 0x730, 0x748),
-    HighScoreEntry(2, 'A', 0x706, 0x733, 0x749),
-    HighScoreEntry(3, 'A', 0x70c, 0x736, 0x74a),
-)
+def get_table_addresses(game_type):
+    prefix = 'high_scores_%s_' % game_type.lower()
+    return tuple(
+        HighScoreEntry(
+            rank+1, game_type,
+            MEMORY_MAP.get_address(prefix + 'name', rank),
+            MEMORY_MAP.get_address(prefix + 'score', rank),
+            MEMORY_MAP.get_address(prefix + 'level', rank))
+        for rank in range(MEMORY_MAP.fields[prefix + 'name'].count))
 
-HIGH_SCORES_B = (
-    HighScoreEntry(1, 'B', 0x718, 0x73c, 0x74c),
-    HighScoreEntry(2, 'B', 0x71e, 0x73f, 0x74d),
-    HighScoreEntry(3, 'B', 0x724, 0x742, 0x74e),
-)
+HIGH_SCORES_A = get_table_addresses('A')
+HIGH_SCORES_B = get_table_addresses('B')
 
 DEFAULT_HIGH_SCORES = (
     HighScoreEntry(1, 'A', 'HOWARD', 10000, 9),
@@ -50,22 +58,36 @@ DEFAULT_HIGH_SCORES = (
     HighScoreEntry(3, 'B', 'NINTEN', 500, 0),
 )
 
-VERTICAL_POS = 0x61
-NEXT_PIECE = 0x62
-CURRENT_PIECE = 0xbf
+VERTICAL_POS = MEMORY_MAP.get_address('vertical_pos')
+NEXT_PIECE = MEMORY_MAP.get_address('next_piece')
+CURRENT_PIECE = MEMORY_MAP.get_address('current_piece')
 
 LINE_PIECE = 18
 
-HIGH_SCORES_START = 0x700
-HIGH_SCORES_END = 0x74e
+# Tetris writes these bytes when it powers up (to tell a warm reset from a
+# cold one) so they make a handy fingerprint for the game
+SIGNATURE_START = MEMORY_MAP.signature_address
+SIGNATURE = MEMORY_MAP.signature
+
+HIGH_SCORE_FIELDS = (
+    'high_scores_a_name', 'high_scores_a_score', 'high_scores_a_level',
+    'high_scores_b_name', 'high_scores_b_score', 'high_scores_b_level',
+)
+HIGH_SCORES_START, HIGH_SCORES_END = MEMORY_MAP.get_range(HIGH_SCORE_FIELDS)
+
+# Decodes both high-score tables in one go
+HIGH_SCORES_PLAN = MEMORY_MAP.compile(HIGH_SCORE_FIELDS)
 
-CURRENT_SCORE_START = 0x73
-CURRENT_SCORE_BYTES = 3
+# The running totals for the game in progress
+STATS_PLAN = MEMORY_MAP.compile(
+    ('current_score', 'level', 'lines', 'next_piece'))
 
-PLAY_AREA_START = 0x400
-PLAY_AREA_BYTES = 200
-PLAY_AREA_ROWS = 20
-PLAY_AREA_COLS = 10
+CURRENT_SCORE_START = MEMORY_MAP.get_address('current_score')
+CURRENT_SCORE_BYTES = MEMORY_MAP.fields['current_score'].size
+
+PLAY_AREA_START = MEMORY_MAP.get_address('play_area')
+PLAY_AREA_BYTES = MEMORY_MAP.fields['play_area'].size
+PLAY_AREA_ROWS, PLAY_AREA_COLS = MEMORY_MAP.fields['play_area'].shape
 
 PLAY_AREA_BAR_FILL = 0x4f
 PLAY_AREA_EMPTY = 0xef
@@ -73,37 +95,65 @@ PLAY_AREA_WHITE = 0x7b
 PLAY_AREA_CYAN = 0x7c
 PLAY_AREA_BLUE = 0x7d
 
-def get_high_scores_by_table(ram, table, game_type):
+# Goes up by one every frame (see nes.snapshot)
+FRAME_COUNTER = Region(
+    'frame-counter', MEMORY_MAP.get_address('frame_counter'),
+    MEMORY_MAP.fields['frame_counter'].size)
+
+# The parts of RAM the game state logic depends on
+WATCHED_REGIONS = (
+    Region('score', CURRENT_SCORE_START, CURRENT_SCORE_BYTES),
+    Region('high-scores', HIGH_SCORES_START,
+           HIGH_SCORES_END-HIGH_SCORES_START+1),
+    Region('play-area', PLAY_AREA_START, PLAY_AREA_BYTES),
+    Region('piece', VERTICAL_POS, 2),
+    Region('current-piece', CURRENT_PIECE, 1),
+)
+
+@functools.lru_cache(maxsize=32)
+def decode_high_scores(data):
+    """Decodes the raw bytes of the high-score tables (HIGH_SCORES_START to
+    HIGH_SCORES_END). Results are cached, so decoding a table that hasn't
+    changed is just a lookup."""
+    values = HIGH_SCORES_PLAN.decode(data, base=HIGH_SCORES_START)
+
     lst = []
-    for count, entry in enumerate(table):
-        name = ram[entry.name:entry.name+6]
-        score = ram[entry.score:entry.score+3]
-        level = ram[entry.level]
-
-        if name[0] == 0xff:
-            # RAM hasn't been initalized yet
-            return None
-
-        name = "".join(byte_to_char(ch) for ch in name)
-        # Note: the score is BCD encoded
-        try:
-            score = int("".join('%02x' % ch for ch in score))
-        except:
-            # If the score isn't valid, the table probably isn't valid
-            return None
-
-        lst.append(HighScoreEntry(count+1, game_type, name, score, level))
-    return lst
+    for game_type, names, scores, levels in (
+            ('A', values.high_scores_a_name, values.high_scores_a_score,
+             values.high_scores_a_level),
+            ('B', values.high_scores_b_name, values.high_scores_b_score,
+             values.high_scores_b_level)):
+        prefix = 'high_scores_%s_name' % game_type.lower()
+        for rank in range(len(names)):
+            if data[MEMORY_MAP.get_address(prefix, rank) -
+                    HIGH_SCORES_START] == 0xff:
+                # RAM hasn't been initalized yet
+                return None
+            if scores[rank] is None:
+                # If the score isn't valid, the table probably isn't valid
+                return None
+            lst.append(HighScoreEntry(
+                rank+1, game_type, names[rank], scores[rank], levels[rank]))
+    return tuple(lst)
 
 def get_high_scores(ram):
     """Extracts and returns the high scores from the given block of RAM."""
-    a_list = get_high_scores_by_table(ram, HIGH_SCORES_A, 'A')
-    if not a_list:
-        return None
-    b_list = get_high_scores_by_table(ram, HIGH_SCORES_B, 'B')
-    if not b_list:
-        return None
-    return a_list + b_list
+    return decode_high_scores(bytes(get_high_scores_view(ram)))
+
+def get_play_area(ram):
+    '''Returns a (rows x cols) array view of the play area. This refers
+    directly to the given RAM, so copy it if you need to keep it.'''
+    area = as_array(ram)[PLAY_AREA_START:PLAY_AREA_START+PLAY_AREA_BYTES]
+    return area.reshape((PLAY_AREA_ROWS, PLAY_AREA_COLS))
+
+def get_high_scores_view(ram):
+    '''Returns a memoryview of the raw high-score tables'''
+    return as_view(ram)[HIGH_SCORES_START:HIGH_SCORES_END+1]
+
+def get_current_score_view(ram):
+    '''Returns a memoryview of the raw (BCD, little-endian) current score'''
+    return as_view(ram)[
+        CURRENT_SCORE_START:CURRENT_SCORE_START+CURRENT_SCORE_BYTES]
 
 def get_current_score_bytes(ram):
     return (ram[CURRENT_SCORE_START],
@@ -112,6 +162,14 @@ def get_current_score_bytes(ram):
 
 def get_current_score(ram):
     '''Returns the score of the game currently being played'''
-    #lst = ram[CURRENT_SCORE_START:CURRENT_SCORE_START+CURRENT_SCORE_BYTES]
     lst = get_current_score_bytes(ram)
-    return int(''.join('%02x' % n for n in reversed(lst)))
+    score = decode_bcd(reversed(lst))
+    if score is None:
+        raise ValueError('invalid BCD score: %r' % (lst,))
+    return score
+
+def get_game_stats(ram):
+    '''Returns the score, level, line count and next piece of the game
+    being played (see STATS_PLAN). The score and lines are None if they
+    aren't valid BCD.'''
+    return STATS_PLAN.decode(ram)
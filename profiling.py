@@ -0,0 +1,144 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# On-demand profiling for a running watcher. Nothing here runs until a
+# profile is asked for (eg with SIGUSR1) and then only for a fixed window:
+#
+# * a background thread samples the stacks of every other thread, giving
+#   collapsed stacks ("a;b;c count" lines, as used by flamegraph.pl)
+# * tracemalloc records allocations, and the sites that grew the most over
+#   the window are written out
+#
+# The sampler runs in its own thread, so the code being profiled isn't
+# touched at all.
+#
+
+import collections
+import os
+import sys
+import threading
+import time
+
+# How often to sample stacks, and how many allocation sites to report
+SAMPLE_INTERVAL = 0.005
+TOP_ALLOCATIONS = 25
+
+def format_frame(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def collapse_stack(frame):
+    '''Returns the stack ending at the given frame as "outer;...;inner"'''
+    names = []
+    while frame is not None:
+        names.append(format_frame(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class Profiler:
+    '''Profiles the whole process for a while, then writes the results to
+    files in output_dir (named after the time the profile started)'''
+
+    def __init__(self, output_dir, duration=30, interval=SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.duration = duration
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        '''Starts profiling in the background. Does nothing if a profile is
+        already being taken.'''
+        with self.lock:
+            if self.thread:
+                return False
+            self.thread = threading.Thread(
+                target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+        return True
+
+    def run(self):
+        # Loaded here since it isn't needed until we profile, and it takes a
+        # while to import
+        import tracemalloc
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        try:
+            before = tracemalloc.take_snapshot()
+            stacks = self.sample_stacks()
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+        # Leave out our own allocations
+        ignore = (
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        )
+        try:
+            self.save(stacks, after.filter_traces(ignore).compare_to(
+                before.filter_traces(ignore), 'lineno'))
+        finally:
+            with self.lock:
+                self.thread = None
+
+    def sample_stacks(self):
+        '''Samples the stacks of all other threads for the profile window.
+        Returns a Counter of collapsed stacks.'''
+        stacks = collections.Counter()
+        me = threading.get_ident()
+        names = {}
+        end = time.monotonic() + self.duration
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {
+                        thread.ident : thread.name
+                        for thread in threading.enumerate()
+                    }
+                stacks['%s;%s' % (
+                    names.get(ident, ident), collapse_stack(frame))] += 1
+            # Don't keep frames alive between samples
+            frame = None
+            time.sleep(self.interval)
+        return stacks
+
+    def save(self, stacks, allocations):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir, time.strftime('profile-%Y%m%d-%H%M%S'))
+
+        with open(prefix + '.collapsed', 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write('%s %d\n' % (stack, count))
+
+        with open(prefix + '-alloc.txt', 'w') as file:
+            file.write('Top %d allocation sites over %gs:\n\n' % (
+                TOP_ALLOCATIONS, self.duration))
+            for stat in allocations[:TOP_ALLOCATIONS]:
+                file.write('%s\n' % stat)
+
+        print('profile written to %s.*' % prefix)
@@ -0,0 +1,219 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import queue
+import threading
+import time
+
+from metrics import LatencyHistogram, Metric, COUNTER, GAUGE, HISTOGRAM
+
+class PermanentError(Exception):
+    '''Raised by a backend when a message will never be accepted (eg it's
+    a duplicate), so there's no point retrying it'''
+
+class NullBackend:
+    '''Publishes nowhere (eg for benchmarking)'''
+
+    def publish(self, msg):
+        pass
+
+class FileBackend:
+    '''Appends each message as a line to a file. Handy as a stand-in for
+    the real thing when testing.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, msg):
+        with open(self.path, 'a') as file:
+            file.write(msg + '\n')
+
+class HttpBackend:
+    '''POSTs each message as JSON ({"message": ...}) to a URL'''
+
+    TIMEOUT = 10
+
+    def __init__(self, url):
+        self.url = url
+
+    def publish(self, msg):
+        # Only loaded when needed, since it pulls in a lot (http, email, ssl)
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(
+            self.url, data=json.dumps({'message' : msg}).encode('utf-8'),
+            headers={'Content-Type' : 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.TIMEOUT):
+                pass
+        except urllib.error.HTTPError as e:
+            # A client error won't go away by retrying, except for a timeout
+            # or being rate limited. Anything else raised is retried.
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise PermanentError('HTTP %d %s' % (e.code, e.reason))
+            raise
+
+class Publisher:
+    '''Publishes messages from a background thread, so a slow or broken
+    backend never holds up the caller. Failed messages are retried with
+    exponential backoff, up to MAX_ATTEMPTS times. A message the backend
+    rejects outright (PermanentError) isn't retried at all. Either way it's
+    logged and dropped, so it can't hold up the messages behind it. If
+    pending_path is given, messages that haven't been published yet are
+    saved there and picked up again on restart.'''
+
+    MAX_QUEUED = 100
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 300
+    # With the backoff above this is about 8 minutes of retrying
+    MAX_ATTEMPTS = 10
+
+    STOP = object()
+
+    def __init__(self, backend, pending_path=None):
+        self.backend = backend
+        self.pending_path = pending_path
+        self.queue = queue.Queue(self.MAX_QUEUED)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = []
+        # Saved messages that didn't fit in the queue on startup. They stay
+        # pending, and are queued as space frees up.
+        self.backlog = []
+        self.published = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.publish_times = LatencyHistogram()
+
+        self.pending = self.load_pending()
+        self.backlog = list(self.pending)
+        self.queue_backlog()
+
+        self.thread = threading.Thread(
+            target=self.run, name='publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, msg):
+        '''Queues a message for publishing. This never blocks.'''
+        with self.lock:
+            # Save it before queueing, since the worker could publish it (and
+            # remove it from pending) as soon as it's on the queue
+            self.pending.append(msg)
+            self.save_pending()
+            try:
+                self.queue.put_nowait(msg)
+                return
+            except queue.Full:
+                self.pending.pop()
+                self.save_pending()
+
+        print('publish queue is full, dropping: %s' % msg)
+        self.dropped += 1
+
+    def queue_backlog(self):
+        '''Moves saved messages onto the queue while there is room. The
+        caller should hold the lock.'''
+        while self.backlog:
+            try:
+                self.queue.put_nowait(self.backlog[0])
+            except queue.Full:
+                return
+            self.backlog.pop(0)
+
+    def close(self, timeout=None):
+        '''Stops the publishing thread. Anything not yet published stays
+        saved for next time.'''
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(self.STOP)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def load_pending(self):
+        if not self.pending_path or not os.path.exists(self.pending_path):
+            return []
+        with open(self.pending_path) as file:
+            return json.load(file)
+
+    def save_pending(self):
+        if not self.pending_path:
+            return
+        # Write then rename so a crash never leaves a half-written file
+        tmp_path = self.pending_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.pending, file)
+        os.replace(tmp_path, self.pending_path)
+
+    def run(self):
+        while not self.stopping.is_set():
+            msg = self.queue.get()
+            if msg is self.STOP:
+                break
+
+            delay = self.RETRY_DELAY
+            for attempt in range(1, self.MAX_ATTEMPTS+1):
+                start = time.monotonic()
+                try:
+                    self.backend.publish(msg)
+                    self.publish_times.record(time.monotonic()-start)
+                    self.published += 1
+                    break
+                except PermanentError as e:
+                    self.failures += 1
+                    self.rejected += 1
+                    print('publishing rejected (%s), dropping: %s' % (e, msg))
+                    break
+                except Exception as e:
+                    self.failures += 1
+                    if attempt == self.MAX_ATTEMPTS:
+                        self.rejected += 1
+                        print('publishing failed %d times (%s), dropping: %s'
+                              % (attempt, e, msg))
+                        break
+                    print('publishing failed (%s), retrying in %gs' % (
+                        e, delay))
+                    if self.stopping.wait(delay):
+                        return
+                    delay = min(delay*2, self.MAX_RETRY_DELAY)
+
+            with self.lock:
+                if msg in self.pending:
+                    self.pending.remove(msg)
+                    self.save_pending()
+                self.queue_backlog()
+
+    def collect_metrics(self):
+        yield Metric('nes_published_total', COUNTER,
+                     'Messages published', {}, self.published)
+        yield Metric('nes_publish_failures_total', COUNTER,
+                     'Failed attempts to publish a message', {},
+                     self.failures)
+        yield Metric('nes_publish_dropped_total', COUNTER,
+                     'Messages dropped because the queue was full', {},
+                     self.dropped)
+        yield Metric('nes_publish_rejected_total', COUNTER,
+                     'Messages given up on after failing to publish', {},
+                     self.rejected)
+        yield Metric('nes_publish_pending', GAUGE,
+                     'Messages waiting to be published', {},
+                     len(self.pending))
+        yield Metric('nes_publish_seconds', HISTOGRAM,
+                     'Time taken to publish a message', {},
+                     self.publish_times)
@@ -0,0 +1,124 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from metrics import LatencyHistogram, Metric, COUNTER, GAUGE, HISTOGRAM
+
+# The NES (NTSC) runs at a little over 60 frames per second
+FRAME_TIME = 1/60.0988
+
+class SampleScheduler:
+    '''Decides how often to sample the NES ram, based on the game state.
+
+    Samples are placed on a fixed grid (rather than sleeping a fixed time
+    after each one) so the rate doesn't drift with how long a sample takes.
+    A sample that starts well after its slot is counted as late, and any
+    whole slots we fell behind by are counted as skipped.'''
+
+    # How often to sample (in seconds) depending on what the game is doing.
+    # While a game is in progress we want every piece, so run at close to
+    # the frame rate. Otherwise we're just waiting for something to happen.
+    NO_ROM_INTERVAL = 2
+    IDLE_INTERVAL = 0.5
+    PLAYING_INTERVAL = FRAME_TIME
+
+    # How far past its slot (as a fraction of the interval) a sample can
+    # start before it's considered late
+    LATE_TOLERANCE = 0.5
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.interval = None
+        self.deadline = None
+        self.sample_start = None
+        self.samples = 0
+        self.late = 0
+        self.skipped = 0
+        self.max_lag = 0
+        self.lags = LatencyHistogram()
+
+    def get_interval(self, game_state):
+        if game_state.ram is None or not game_state.playing_tetris:
+            return self.NO_ROM_INTERVAL
+
+        if game_state.state in (game_state.PLAYING, game_state.FINISHING):
+            return self.PLAYING_INTERVAL
+
+        return self.IDLE_INTERVAL
+
+    def begin(self):
+        '''Called just before taking a sample'''
+        now = self.clock()
+        self.samples += 1
+        self.sample_start = now
+
+        if self.deadline is None:
+            return
+
+        lag = now - self.deadline
+        self.max_lag = max(self.max_lag, lag)
+        self.lags.record(max(lag, 0))
+        if lag > self.interval*self.LATE_TOLERANCE:
+            self.late += 1
+
+        # Drop any slots we missed entirely, rather than trying to catch up
+        # with a burst of samples
+        missed = int(lag // self.interval)
+        if missed > 0:
+            self.skipped += missed
+            self.deadline += missed*self.interval
+
+    def next_delay(self, game_state):
+        '''Called after taking a sample. Returns how long to wait (in
+        seconds) before taking the next one.'''
+        interval = self.get_interval(game_state)
+
+        if self.deadline is None or interval != self.interval:
+            # Start a new schedule whenever the sampling rate changes
+            self.deadline = self.sample_start
+        self.interval = interval
+        self.deadline += interval
+
+        return max(0, self.deadline - self.clock())
+
+    def pause(self):
+        '''Called when we stop sampling for a while on purpose (eg waiting
+        for the emulator to start) so the gap isn't counted as lateness'''
+        self.deadline = None
+
+    def get_stats(self):
+        return {
+            'samples' : self.samples,
+            'late' : self.late,
+            'skipped' : self.skipped,
+            'max_lag' : self.max_lag,
+        }
+
+    def collect_metrics(self, labels):
+        yield Metric('nes_samples_total', COUNTER,
+                     'Samples taken of the NES ram', labels, self.samples)
+        yield Metric('nes_samples_late_total', COUNTER,
+                     'Samples that started well after their slot', labels,
+                     self.late)
+        yield Metric('nes_samples_skipped_total', COUNTER,
+                     'Sample slots missed entirely', labels, self.skipped)
+        yield Metric('nes_sample_lag_seconds', HISTOGRAM,
+                     'How late each sample started', labels, self.lags)
+        yield Metric('nes_sample_max_lag_seconds', GAUGE,
+                     'Worst sample lag seen', labels, self.max_lag)
+        yield Metric('nes_sample_interval_seconds', GAUGE,
+                     'Current sampling interval', labels, self.interval or 0)
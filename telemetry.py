@@ -0,0 +1,121 @@
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Per-game telemetry: a row per piece (score, stack height, level, the board
+# packed into 25 bytes, etc) kept in a preallocated ring buffer, and saved as
+# columns in an .npz file when the game ends. The buffer is reused from game
+# to game, so memory use stays the same however long the watcher runs.
+#
+# numpy is only imported once the first row is recorded, so it doesn't slow
+# down starting the watcher.
+#
+
+import os
+import time
+
+# One row per piece (as a numpy dtype)
+ROW_FIELDS = (
+    ('timestamp', 'f8'),
+    ('score', 'u4'),
+    ('height', 'u1'),
+    ('level', 'u1'),
+    ('lines', 'u2'),
+    ('piece', 'u1'),
+    # See board.PackedBoard.to_bytes
+    ('board', 'V25'),
+)
+
+# Even a long game is only a few hundred pieces. If a game goes past this
+# we keep the most recent rows.
+CAPACITY = 4096
+
+def create_unique(base, ext):
+    '''Creates a new file called base + ext, or base-2 + ext (and so on) if
+    that's taken. Returns the path and the open file.'''
+    n = 1
+    while True:
+        path = base + ('-%d' % n if n > 1 else '') + ext
+        try:
+            return path, open(path, 'xb')
+        except FileExistsError:
+            n += 1
+
+class GameTelemetry:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        # Allocated on first use (see allocate)
+        self.rows = None
+        self.count = 0
+        self.started = None
+
+    def allocate(self):
+        import numpy as np
+        self.rows = np.zeros(self.capacity, dtype=list(ROW_FIELDS))
+
+    def reset(self):
+        self.count = 0
+        self.started = None
+
+    def record(self, timestamp, score, height, level, lines, piece,
+               board=bytes(25)):
+        if self.started is None:
+            self.started = time.time()
+        if self.rows is None:
+            self.allocate()
+        self.rows[self.count % self.capacity] = (
+            timestamp, score, height, level, lines, piece, board)
+        self.count += 1
+
+    def get_dropped(self):
+        '''Returns how many rows were overwritten this game'''
+        return max(0, self.count - self.capacity)
+
+    def get_rows(self):
+        '''Returns a copy of this game's rows, oldest first'''
+        import numpy as np
+        if self.rows is None:
+            self.allocate()
+        if self.count <= self.capacity:
+            return self.rows[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def save(self, path, **info):
+        '''Writes the rows out as a column per field, along with any extra
+        (scalar) info given'''
+        import numpy as np
+        rows = self.get_rows()
+        columns = {name : rows[name] for name, kind in ROW_FIELDS}
+        np.savez_compressed(
+            path, started=self.started or 0, dropped=self.get_dropped(),
+            **info, **columns)
+
+    def flush(self, output_dir, name):
+        '''Saves the game (if any pieces were recorded) to a new file in
+        output_dir and resets for the next one. Returns the path written,
+        or None.'''
+        path = None
+        if self.count:
+            os.makedirs(output_dir, exist_ok=True)
+            # Two games can finish in the same second, so don't overwrite
+            path, file = create_unique(os.path.join(output_dir, '%s-%s' % (
+                name, time.strftime(
+                    '%Y%m%d-%H%M%S', time.localtime(self.started)))), '.npz')
+            with file:
+                self.save(file, cabinet=name)
+        self.reset()
+        return path
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Reprocesses recorded sessions (see record_session.py) with the current
+# game state logic, to rebuild the leaderboard and gather stats about the
+# games played. Each recording is replayed headless through the same
+# Cabinet handlers the watcher uses, in a pool of worker processes, and the
+# results are merged at the end:
+#
+#   PYTHONPATH=. tools/analyze_sessions.py recordings/*.nesrec \
+#       --leaderboard rebuilt.db
+#
+# A summary is printed as JSON.
+#
+
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from nes.ram import Ram
+from nes.recording import RecordingReader
+from tweeting import Tweeter
+from leaderboard import Leaderboard
+from publishing import Publisher, NullBackend
+from watch_for_high_scores import Cabinet
+from gamestate import Dispatcher
+from metrics import LatencyHistogram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRETS_SAMPLE = os.path.join(ROOT, 'secrets.sample')
+
+# The play area is 20 rows high
+MAX_HEIGHT = 20
+
+def analyze_recording(path, cabinet_name=None):
+    '''Replays a single recording, returning what we learned from it. This
+    runs in a worker process, so everything returned has to pickle.'''
+    reader = RecordingReader(path)
+    ram = Ram(bytearray(reader.frame_size))
+    name = cabinet_name or os.path.splitext(os.path.basename(path))[0]
+
+    # Handlers run inline, and new high scores go nowhere
+    cabinet = Cabinet(
+        name, Tweeter(SECRETS_SAMPLE), Leaderboard(':memory:'),
+        Publisher(NullBackend()), dispatcher=Dispatcher())
+    cabinet.ram = ram
+    game_state = cabinet.game_state
+
+    games = []
+    heights = np.zeros(MAX_HEIGHT+1, dtype=np.int64)
+    update_times = LatencyHistogram()
+    timestamp = None
+    started = None
+
+    def game_started(game):
+        nonlocal started
+        started = timestamp
+
+    def game_finishing(game):
+        # The cabinet resets its telemetry once the game is finished, so
+        # grab it now
+        rows = cabinet.telemetry.get_rows()
+        heights[:] += np.bincount(rows['height'], minlength=MAX_HEIGHT+1)
+        stats = game.get_game_stats()
+        games.append({
+            'score' : stats.current_score,
+            'level' : stats.level,
+            'lines' : stats.lines,
+            'pieces' : cabinet.telemetry.count,
+            'seconds' : timestamp - started if started is not None else None,
+        })
+
+    # Each new high score, with the (recording) timestamp of the frame it
+    # turned up on
+    scores = []
+
+    def scores_updated(game):
+        # These run after the cabinet has added any new scores
+        new_scores = cabinet.score_tracker.leaderboard.get_all()[len(scores):]
+        scores.extend((score, timestamp) for score in new_scores)
+
+    game_state.connect('started-game', game_started)
+    game_state.connect('finishing-game', game_finishing)
+    game_state.connect('rom-ready', scores_updated)
+    game_state.connect('finished-game', scores_updated)
+
+    frame_count = 0
+    start = time.perf_counter()
+    # The cabinet logs every event, which we don't want to see here
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+        for timestamp, frame in reader.frames():
+            ram[:] = frame
+            if frame_count == 0:
+                game_state.rom_started(ram, game_id='tetris')
+            update_start = time.perf_counter()
+            game_state.update()
+            update_times.record(time.perf_counter() - update_start)
+            frame_count += 1
+        elapsed = time.perf_counter() - start
+        cabinet.publisher.close(timeout=1)
+
+    # Timestamps are from the start of the recording, which isn't stored.
+    # The file was last written when the recording ended though.
+    started = os.path.getmtime(path) - (timestamp or 0)
+
+    return {
+        'path' : path,
+        'frames' : frame_count,
+        'seconds' : elapsed,
+        'games' : games,
+        'scores' : [
+            (score, started + offset) for score, offset in scores],
+        'heights' : heights,
+        'update_times' : update_times,
+    }
+
+def find_recordings(patterns):
+    '''Returns the recordings matching the given patterns, along with any
+    patterns that didn't match anything'''
+    paths = []
+    missing = []
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            missing.append(pattern)
+        paths.extend(matches)
+    # Start the biggest recordings first, so one long session doesn't end up
+    # running on its own at the end
+    return sorted(set(paths), key=os.path.getsize, reverse=True), missing
+
+def analyze(paths, jobs, cabinet_name, leaderboard):
+    results = []
+    jobs = min(jobs, len(paths))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = {
+            executor.submit(analyze_recording, path, cabinet_name) : path
+            for path in paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print('%s: failed (%s)' % (futures[future], e),
+                      file=sys.stderr)
+                continue
+            print('%s: %d frames, %d games' % (
+                result['path'], result['frames'], len(result['games'])),
+                file=sys.stderr)
+            results.append(result)
+
+    heights = np.zeros(MAX_HEIGHT+1, dtype=np.int64)
+    update_times = LatencyHistogram()
+    games = []
+    scores = []
+    for result in results:
+        heights += result['heights']
+        update_times.merge(result['update_times'])
+        games.extend(result['games'])
+        scores.extend(result['scores'])
+
+    # Oldest first, so each score is credited to the first game it turned
+    # up in
+    scores.sort(key=lambda score: score[1])
+    new_scores = 0
+    for score, recorded in scores:
+        new_scores += len(leaderboard.add_entries(
+            score.cabinet, [score], recorded))
+
+    finished = [game for game in games if game['score'] is not None]
+    return {
+        'recordings' : len(results),
+        'failed' : len(paths) - len(results),
+        'frames' : sum(result['frames'] for result in results),
+        'games' : len(games),
+        'new_scores' : new_scores,
+        'best_score' : max(
+            (game['score'] for game in finished), default=None),
+        'mean_score' : (
+            sum(game['score'] for game in finished)/len(finished)
+            if finished else None),
+        'mean_pieces' : (
+            sum(game['pieces'] for game in games)/len(games)
+            if games else None),
+        'height_histogram' : heights.tolist(),
+        'update' : {
+            'mean_us' : 1e6*update_times.get_mean(),
+            'p99_us' : 1e6*update_times.get_percentile(99),
+            'max_us' : 1e6*update_times.max,
+        },
+        'top' : {
+            game_type : [
+                score._asdict() for score in leaderboard.get_top(game_type)]
+            for game_type in ('A', 'B')
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays recorded sessions in parallel, rebuilding the '
+        'leaderboard and gathering stats about the games played')
+    parser.add_argument(
+        'recordings', nargs='+',
+        help='recording files (glob patterns are allowed)')
+    parser.add_argument(
+        '--jobs', type=int, default=os.cpu_count(),
+        help='number of worker processes (default %(default)s)')
+    parser.add_argument(
+        '--cabinet',
+        help='cabinet to credit all the scores to (default is the name of '
+        'each recording)')
+    parser.add_argument(
+        '--leaderboard', default=':memory:',
+        help='database to add the scores to (by default they are only '
+        'summarized)')
+    args = parser.parse_args()
+
+    paths, missing = find_recordings(args.recordings)
+    if missing:
+        parser.error('no recordings found for %s' % ', '.join(missing))
+    leaderboard = Leaderboard(args.leaderboard)
+    start = time.perf_counter()
+    try:
+        summary = analyze(paths, args.jobs, args.cabinet, leaderboard)
+    finally:
+        leaderboard.close()
+    elapsed = time.perf_counter() - start
+    summary['seconds'] = elapsed
+    summary['frames_per_second'] = summary['frames']/elapsed
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
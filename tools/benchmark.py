@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Benchmarks the watcher pipeline (game state, event handlers, high-score
+# tracking and tweet formatting) by feeding it a stream of RAM frames as
+# fast as possible. Frames come from the RAM snapshots, a recording, or a
+# synthesized series of games. Publishing goes through the usual queue, but
+# to a backend that does nothing.
+#
+# Results are printed as JSON. Use --thresholds to give a JSON file of
+# limits on the results, eg:
+#
+#   {"frames_per_second": {"min": 2000}, "stages.update.mean_us": {"max": 50}}
+#
+# The exit status is non-zero if any threshold is exceeded.
+#
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from nes import tetris, board
+from nes.ram import Ram
+from nes.recording import RecordingReader
+from tweeting import Tweeter
+from leaderboard import Leaderboard
+from publishing import Publisher, NullBackend
+from watch_for_high_scores import Cabinet
+from gamestate import Dispatcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS_DIR = os.path.join(ROOT, 'ram-snapshots')
+SECRETS_SAMPLE = os.path.join(ROOT, 'secrets.sample')
+
+# The watcher has to keep up with the NES frame rate on every cabinet
+FRAME_RATE = 60
+
+def to_bcd(value, size):
+    '''Returns value as big-endian BCD bytes'''
+    digits = '%0*d' % (size*2, value)
+    return bytes(int(digits[n:n+2], 16) for n in range(0, size*2, 2))
+
+def encode_name(name):
+    return bytes(tetris.LETTER_MAP.index(ch) for ch in name)
+
+def synthesize_games(base_frame, games, pieces):
+    '''Returns the frames of a series of made up games. Pieces drop one row
+    per frame and stack up in the play area, and each game ends with a new
+    high score being entered.'''
+    ram = bytearray(base_frame)
+    frames = []
+
+    def hold(count):
+        frames.extend(bytes(ram) for n in range(count))
+
+    area_end = tetris.PLAY_AREA_START + tetris.PLAY_AREA_BYTES
+    score_end = tetris.CURRENT_SCORE_START + tetris.CURRENT_SCORE_BYTES
+    for game in range(games):
+        # Sitting on the menu with the last game's score
+        ram[tetris.CURRENT_SCORE_START:score_end] = b'\x00\x10\x00'
+        hold(30)
+        ram[tetris.CURRENT_SCORE_START:score_end] = b'\x00\x00\x00'
+        hold(30)
+
+        score = 0
+        for piece in range(pieces):
+            for row in range(tetris.PLAY_AREA_ROWS):
+                ram[tetris.VERTICAL_POS] = row
+                hold(1)
+            cell = (tetris.PLAY_AREA_BYTES - 1 -
+                    piece % tetris.PLAY_AREA_BYTES)
+            ram[tetris.PLAY_AREA_START+cell] = tetris.PLAY_AREA_WHITE
+            score += 40
+            ram[tetris.CURRENT_SCORE_START:score_end] = bytes(
+                reversed(to_bcd(score, tetris.CURRENT_SCORE_BYTES)))
+
+        ram[tetris.PLAY_AREA_START:area_end] = bytes(
+            [tetris.PLAY_AREA_BAR_FILL]) * tetris.PLAY_AREA_BYTES
+        hold(60)
+
+        entry = tetris.HIGH_SCORES_A[0]
+        ram[entry.name:entry.name+6] = encode_name('GAME%02d' % (game % 100))
+        ram[entry.score:entry.score+3] = to_bcd(20000+score, 3)
+        ram[entry.level] = game % 20
+        ram[tetris.PLAY_AREA_START:area_end] = bytes(
+            [tetris.PLAY_AREA_EMPTY]) * tetris.PLAY_AREA_BYTES
+        hold(60)
+
+    return frames
+
+def load_snapshots(path, repeat):
+    frames = []
+    for filename in sorted(glob.glob(os.path.join(path, '*.bin'))):
+        with open(filename, 'rb') as file:
+            frames.extend([file.read()] * repeat)
+    return frames
+
+def load_recording(path):
+    with RecordingReader(path) as reader:
+        return [frame for timestamp, frame in reader]
+
+class StageTimer:
+    '''Accumulates the time spent in each stage of the pipeline'''
+
+    def __init__(self):
+        self.stages = {}
+
+    def wrap(self, name, func):
+        stats = self.stages.setdefault(name, [0, 0, 0])
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return wrapper
+
+    def get_results(self, frame_count):
+        return {
+            name : {
+                'calls' : calls,
+                'seconds' : total,
+                'mean_us' : 1e6*total/calls if calls else 0,
+                'max_us' : 1e6*longest,
+                'us_per_frame' : 1e6*total/frame_count,
+            }
+            for name, (calls, total, longest) in self.stages.items()
+        }
+
+@contextlib.contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+# New high scores are queued for publishing, but go nowhere
+publisher = Publisher(NullBackend())
+
+def make_cabinet(frames, tweeter):
+    ram = Ram(bytearray(frames[0]))
+    # Handlers are run inline (rather than queued) so we measure them too
+    cabinet = Cabinet(
+        'benchmark', tweeter, Leaderboard(':memory:'), publisher,
+        dispatcher=Dispatcher())
+    cabinet.ram = ram
+    cabinet.game_state.rom_started(ram, game_id='tetris')
+    return cabinet
+
+def run(cabinet, frames):
+    ram = cabinet.ram
+    update = cabinet.game_state.update
+    start = time.perf_counter()
+    for frame in frames:
+        ram[:] = frame
+        update()
+    return time.perf_counter() - start
+
+def run_staged(frames, tweeter):
+    '''Runs the pipeline with each stage individually timed'''
+    timer = StageTimer()
+    with contextlib.ExitStack() as stack:
+        for module, name, stage in (
+                (tetris, 'get_current_score_bytes', 'decode.score_bytes'),
+                (tetris, 'get_game_stats', 'decode.game_stats'),
+                (tetris, 'get_high_scores', 'decode.high_scores'),
+                (board, 'analyze', 'board')):
+            stack.enter_context(patched(
+                module, name, timer.wrap(stage, getattr(module, name))))
+
+        cabinet = make_cabinet(frames, tweeter)
+        game_state = cabinet.game_state
+        game_state.update = timer.wrap('update', game_state.update)
+        game_state.dispatcher.emit = timer.wrap(
+            'dispatch', game_state.dispatcher.emit)
+        cabinet.score_tracker.update = timer.wrap(
+            'tracker', cabinet.score_tracker.update)
+        tweeter.make_tweet = timer.wrap('tweet', tweeter.make_tweet)
+        try:
+            run(cabinet, frames)
+        finally:
+            del tweeter.make_tweet
+    return timer.get_results(len(frames))
+
+def run_traced(frames, tweeter):
+    '''Runs the pipeline under tracemalloc, measuring the memory allocated
+    while processing frames. Blocks are counted by comparing snapshots
+    taken before and after, so only allocations still held at the end are
+    counted.'''
+    cabinet = make_cabinet(frames, tweeter)
+    # Leave out tracemalloc's own bookkeeping
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        baseline, _ = tracemalloc.get_traced_memory()
+        run(cabinet, frames)
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+    finally:
+        tracemalloc.stop()
+    blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'peak_bytes' : peak - baseline,
+        'retained_bytes' : current - baseline,
+        'retained_bytes_per_frame' : (current - baseline) / len(frames),
+        'retained_blocks' : blocks,
+        'retained_blocks_per_frame' : blocks / len(frames),
+    }
+
+def lookup(results, key):
+    value = results
+    for part in key.split('.'):
+        value = value[part]
+    return value
+
+def check_thresholds(results, thresholds):
+    failures = []
+    for key, limits in thresholds.items():
+        try:
+            value = lookup(results, key)
+        except KeyError:
+            failures.append('%s: no such result' % key)
+            continue
+        if 'min' in limits and value < limits['min']:
+            failures.append('%s: %g is below %g' % (key, value, limits['min']))
+        if 'max' in limits and value > limits['max']:
+            failures.append('%s: %g is above %g' % (key, value, limits['max']))
+    return failures
+
+parser = argparse.ArgumentParser(
+    description='Benchmarks the watcher pipeline against a stream of frames')
+source = parser.add_mutually_exclusive_group()
+source.add_argument(
+    '--snapshots', metavar='DIR', nargs='?', const=SNAPSHOTS_DIR,
+    help='replay the RAM snapshots in a directory (default %(const)s)')
+source.add_argument('--recording', help='replay a recorded session')
+parser.add_argument(
+    '--games', type=int, default=4, help='number of games to synthesize')
+parser.add_argument(
+    '--pieces', type=int, default=60, help='number of pieces per game')
+parser.add_argument(
+    '--repeat', type=int, default=500,
+    help='number of frames to hold each snapshot for')
+parser.add_argument(
+    '--rounds', type=int, default=3,
+    help='number of timing runs (the best is reported)')
+parser.add_argument(
+    '--cabinets', type=int, default=1,
+    help='number of cabinets the watcher should keep up with')
+parser.add_argument(
+    '--thresholds', help='JSON file of limits to check the results against')
+parser.add_argument('--output', help='write the results here (not stdout)')
+args = parser.parse_args()
+
+if args.recording:
+    source_name = args.recording
+    frames = load_recording(args.recording)
+elif args.snapshots:
+    source_name = args.snapshots
+    frames = load_snapshots(args.snapshots, args.repeat)
+else:
+    source_name = 'synthesized'
+    with open(os.path.join(SNAPSHOTS_DIR, 'play1.bin'), 'rb') as file:
+        frames = synthesize_games(file.read(), args.games, args.pieces)
+
+if not frames:
+    sys.exit('no frames to benchmark')
+
+tweeter = Tweeter(SECRETS_SAMPLE)
+
+# The handlers log as they go, which we don't want mixed in with the results
+with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    seconds = min(
+        run(make_cabinet(frames, tweeter), frames)
+        for n in range(args.rounds))
+    stages = run_staged(frames, tweeter)
+    allocations = run_traced(frames, tweeter)
+
+thresholds = {
+    'frames_per_second' : {'min' : FRAME_RATE*args.cabinets},
+}
+if args.thresholds:
+    with open(args.thresholds) as file:
+        thresholds.update(json.load(file))
+
+results = {
+    'source' : source_name,
+    'frames' : len(frames),
+    'seconds' : seconds,
+    'frames_per_second' : len(frames)/seconds,
+    'cabinets_at_frame_rate' : len(frames)/seconds/FRAME_RATE,
+    'stages' : stages,
+    'allocations' : allocations,
+    'thresholds' : thresholds,
+}
+results['failures'] = check_thresholds(results, thresholds)
+results['passed'] = not results['failures']
+
+output = json.dumps(results, indent=2, sort_keys=True)
+if args.output:
+    with open(args.output, 'w') as file:
+        file.write(output + '\n')
+else:
+    print(output)
+
+sys.exit(0 if results['passed'] else 1)
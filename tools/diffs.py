@@ -16,56 +16,141 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import mmap
+#
+# Narrows down which RAM addresses hold a value by comparing frames. Live,
+# it reads a filter at the prompt, takes a new snapshot and shows what's
+# left. With --recording it runs the filters over recorded frames instead.
+#
+# Filters:
+#   !     the value changed          =     the value stayed the same
+#   =N    the value is now N         >     the value increased
+#   <     the value decreased        +N/-N the value changed by N
+#
+# An empty line repeats the last filter.
+#
+
+import argparse
 import nes, nes.fceu
+from nes import search
+from nes.recording import RecordingReader
+
+# How many candidates to show after each step
+MAX_SHOWN = 100
+
+OP_SYMBOLS = {
+    search.CHANGED : '!=',
+    search.SAME : '==',
+    search.EQUALS : '=',
+    search.INCREASED : '>',
+    search.DECREASED : '<',
+    search.DELTA : '+',
+}
 
 def parse_int(value):
     if str(value).startswith('0x'):
         return int(value, 16)
     return int(value)
 
-MODE_SAME = 0
-MODE_CHANGED = 1
-MODE_EQUALS_VALUE = 2
+def parse_filter(line):
+    '''Returns the (op, value) described by a filter'''
+    if line == '!':
+        return search.CHANGED, None
+    if line == '=':
+        return search.SAME, None
+    if line.startswith('='):
+        return search.EQUALS, parse_int(line[1:])
+    if line == '>':
+        return search.INCREASED, None
+    if line == '<':
+        return search.DECREASED, None
+    if line.startswith(('+', '-')):
+        delta = parse_int(line[1:])
+        return search.DELTA, delta if line[0] == '+' else -delta
+    raise ValueError('unknown filter: %s' % line)
+
+def show(engine):
+    addresses = engine.get_addresses()
+    for addr in addresses[:MAX_SHOWN]:
+        history = engine.get_history(addr)
+        if len(history) < 2:
+            # Nothing to compare with yet
+            print('%04x: %d' % (addr, history[-1]))
+            continue
+        print('%04x: %d -> %d [%s]' % (
+            addr, history[-2], history[-1],
+            ', '.join(str(d) for d in history),
+        ))
+    if len(addresses) > MAX_SHOWN:
+        print('... and %d more' % (len(addresses) - MAX_SHOWN))
+    print('*** %d candidates' % len(addresses))
 
-m = nes.fceu.open_shm()
+def run_live(args):
+    m = nes.fceu.open_ram(args.shm)
+    engine = search.MemorySearch(m.copy(), args.encoding, args.width)
 
-snapshot = m[:]
-tracking = set(range(len(snapshot)))
-history = [[d] for d in snapshot]
+    op, value = search.CHANGED, None
+    while True:
+        try:
+            line = input("%s> " % OP_SYMBOLS[op]).strip()
+        except EOFError:
+            break
+        if line:
+            try:
+                op, value = parse_filter(line)
+            except ValueError as e:
+                print(e)
+                continue
 
-mode = MODE_CHANGED
-while True:
-    if mode == MODE_CHANGED: op = '!='
-    else: op = '=='
-    line = input("%s> " % op).strip()
+        engine.step(m.copy(), op, value)
+        show(engine)
 
-    if line == '=':
-        mode = MODE_SAME
-    elif line.startswith('='):
-        mode = MODE_EQUALS_VALUE
-        mode_match = parse_int(line[1:])
-    elif line == '!':
-        mode = MODE_CHANGED
-
-    new_snapshot = m[:]
-    new_tracking = []
-    for pos in tracking:
-        match = (
-            (mode == MODE_CHANGED and snapshot[pos] != new_snapshot[pos]) or
-            (mode == MODE_SAME and snapshot[pos] == new_snapshot[pos]) or
-            (mode == MODE_EQUALS_VALUE and new_snapshot[pos] == mode_match))
-
-        if match:
-            new_tracking.append(pos)
-            history[pos].append(new_snapshot[pos])
-
-    for pos in new_tracking:
-        print('%04x: %d -> %d [%s]' % (
-            pos, snapshot[pos], new_snapshot[pos],
-            ', '.join(str(d) for d in history[pos]),
-        ))
-    print('***')
+def run_recording(args):
+    filters = [parse_filter(line) for line in args.filter or ['!']]
+    with RecordingReader(args.recording) as reader:
+        if args.frames:
+            wanted = set(parse_int(n) for n in args.frames.split(','))
+        else:
+            wanted = set(range(0, len(reader), args.every))
+
+        frames = (
+            frame for number, (timestamp, frame) in enumerate(reader)
+            if number in wanted)
+
+        first = next(frames, None)
+        if first is None:
+            parser.error('no frames selected from %s' % args.recording)
+
+        engine = search.MemorySearch(first, args.encoding, args.width)
+        for count, frame in enumerate(frames):
+            # Each step uses the next filter given, the last one repeating
+            op, value = filters[min(count, len(filters)-1)]
+            if not engine.step(frame, op, value):
+                break
+    show(engine)
+
+parser = argparse.ArgumentParser(
+    description='Searches NES RAM for addresses holding a value')
+parser.add_argument(
+    '--shm', default=nes.fceu.DEFAULT_SHM_PATH,
+    help='shm segment to search (when live)')
+parser.add_argument(
+    '--encoding', choices=search.ENCODINGS, default='u8',
+    help='how values are stored')
+parser.add_argument(
+    '--width', type=int, default=1, help='size of BCD values in bytes')
+parser.add_argument('--recording', help='search a recording instead')
+parser.add_argument(
+    '--every', type=int, default=1,
+    help='step through every Nth frame of the recording')
+parser.add_argument(
+    '--frames', help='comma separated frame numbers to step through')
+parser.add_argument(
+    '--filter', action='append',
+    help='filter to apply at each step of a recording (can be given once '
+    'per step, the last one repeating)')
+args = parser.parse_args()
 
-    snapshot = new_snapshot
-    tracking = new_tracking
+if args.recording:
+    run_recording(args)
+else:
+    run_live(args)
@@ -16,87 +16,178 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import mmap
+#
+# Live view of NES RAM, highlighting bytes as they change. Only the cells
+# that changed (or stopped being highlighted) are redrawn each frame, by
+# moving the cursor straight to them, so this is cheap even at 60Hz.
+#
+# usage: dump_mem.py [start] [stop] [--shm PATH ...] [--filter RANGES]
+#
+
+import argparse
 import sys
-import nes, nes.fceu
-import os
-import termcolor
 import time
+import numpy as np
+import nes, nes.fceu
 
-# How long between polling memory for changes
-DELAY = 0.1
 # How long to keep a memory location marked when it changes
 MARK_TIME = 1
+# Bytes shown per line
+COLS = 16
+# Text between panes (and segments) on the same line
+SEPARATOR = ' -- '
+# Where the first line of memory goes (the line above has segment names)
+FIRST_ROW = 2
+
+HEX = ['%02x' % n for n in range(256)]
+RED = '\033[31m'
+RESET = '\033[0m'
 
 def fhex(n, digits):
     return '{number:0{size}x}'.format(number=n, size=digits)
 
-def dump_line(ram, mark_time, start_addr, addr, cols):
-    lst = [
-        fhex(start_addr+addr, 4)
-    ]
-    for offset in range(cols):
-        if addr+offset >= len(ram): break
-        
-        value = fhex(ram[addr+offset], 2)
-
-        if mark_time and mark_time[addr+offset] > 0:
-            value = termcolor.colored(value, 'red')
-        
-        lst.append(value)
-    return lst
-
-def dump_ram(start_addr, ram, last_ram):
-    cols = 16
-    addr = 0
-    half_way = len(ram)//2
-
-    while addr < half_way:
-        line = (
-            dump_line(ram, last_ram, start_addr, addr, cols) + 
-            ['--'] + 
-            dump_line(ram, last_ram, start_addr, half_way+addr, cols)
-        )
-        print(' '.join(line))
-
-        addr += cols
-
-###
-
-start_addr = 0
-stop_addr = 0x800-1
+def move_to(row, col):
+    return '\033[%d;%dH' % (row, col)
 
-try:
-    start_addr = int(sys.argv[1], 16)
-except:
-    pass
+def parse_ranges(text):
+    '''Parses address ranges like "400-4c7,700-74e" (hex, inclusive)'''
+    ranges = []
+    for part in text.split(','):
+        start, _, stop = part.partition('-')
+        start = int(start, 16)
+        ranges.append((start, int(stop, 16) if stop else start))
+    return ranges
+
+class SegmentView:
+    '''Shows part of a single segment's RAM as one or more panes of lines'''
+
+    def __init__(self, path, start_addr, stop_addr, panes, col, ranges):
+        self.path = path
+        self.ram = nes.fceu.open_ram(path)
+        self.start_addr = start_addr
+        self.stop_addr = min(stop_addr, len(self.ram)-1)
+        size = self.stop_addr - start_addr + 1
+
+        shown = np.ones(size, dtype=bool)
+        if ranges:
+            shown[:] = False
+            addrs = np.arange(start_addr, self.stop_addr+1)
+            for low, high in ranges:
+                shown |= (addrs >= low) & (addrs <= high)
+        self.shown = shown
 
+        self.current = np.zeros(size, dtype=np.uint8)
+        self.last = np.zeros(size, dtype=np.uint8)
+        self.mark_until = np.zeros(size)
+        self.marked = np.zeros(size, dtype=bool)
+
+        # Lay the range out in panes side by side, skipping any lines
+        # that have nothing to show. We precompute where every cell goes.
+        self.moves = [None]*size
+        self.labels = []
+        pane_width = 4 + 3*COLS
+        pane_size = -(-size // panes)
+        self.width = panes*pane_width + (panes-1)*len(SEPARATOR)
+        self.rows = 0
+        for pane in range(panes):
+            x = col + pane*(pane_width+len(SEPARATOR))
+            row = FIRST_ROW
+            pane_start = pane*pane_size
+            pane_stop = min(size, pane_start+pane_size)
+            for line in range(pane_start, pane_stop, COLS):
+                line_stop = min(pane_stop, line+COLS)
+                if not shown[line:line_stop].any():
+                    continue
+                self.labels.append(
+                    move_to(row, x) + fhex(start_addr+line, 4))
+                if pane > 0:
+                    self.labels.append(move_to(row, x-3) + '--')
+                for offset in range(line, line_stop):
+                    self.moves[offset] = move_to(
+                        row, x + 5 + 3*(offset-line))
+                row += 1
+            self.rows = max(self.rows, row)
+        self.title = move_to(1, col) + path
+
+    def draw_all(self):
+        '''Returns the text for drawing the whole view from scratch'''
+        np.copyto(self.current, self.ram.get_array(
+            self.start_addr, len(self.current)))
+        np.copyto(self.last, self.current)
+        text = [self.title] + self.labels
+        for offset in np.flatnonzero(self.shown):
+            text.append(self.moves[offset] + HEX[self.current[offset]])
+        return ''.join(text)
+
+    def draw_changes(self, now):
+        '''Returns the text for redrawing just the cells that changed value
+        or highlighting since last time'''
+        np.copyto(self.current, self.ram.get_array(
+            self.start_addr, len(self.current)))
+        changed = self.current != self.last
+        np.copyto(self.last, self.current)
+
+        self.mark_until[changed] = now + MARK_TIME
+        marked = self.mark_until > now
+        dirty = (changed | (marked != self.marked)) & self.shown
+        self.marked = marked
+
+        text = []
+        for offset in np.flatnonzero(dirty):
+            value = HEX[self.current[offset]]
+            if marked[offset]:
+                value = RED + value + RESET
+            text.append(self.moves[offset] + value)
+        return ''.join(text)
+
+parser = argparse.ArgumentParser(
+    description='Shows NES RAM live, highlighting changes')
+parser.add_argument('start', nargs='?', default='0', help='first address (hex)')
+parser.add_argument('stop', nargs='?', default='7ff', help='last address (hex)')
+parser.add_argument(
+    '--shm', action='append',
+    help='shm segment to show (give more than once to show several side '
+    'by side)')
+parser.add_argument(
+    '--filter', help='only show these addresses, eg "400-4c7,700-74e"')
+parser.add_argument(
+    '--rate', type=float, default=60, help='refresh rate (Hz)')
+args = parser.parse_args()
+
+paths = args.shm or [nes.fceu.DEFAULT_SHM_PATH]
+ranges = parse_ranges(args.filter) if args.filter else None
+# A single segment is split into two panes (like before), otherwise each
+# segment gets one
+panes = 2 if len(paths) == 1 else 1
+
+views = []
+col = 1
+for path in paths:
+    view = SegmentView(
+        path, int(args.start, 16), int(args.stop, 16), panes, col, ranges)
+    views.append(view)
+    col += view.width + len(SEPARATOR)
+bottom = max(view.rows for view in views)
+
+# Start by clearing the screen (and hiding the cursor)
+sys.stdout.write('\033[2J\033[?25l')
+sys.stdout.write(''.join(view.draw_all() for view in views))
+sys.stdout.flush()
+
+delay = 1/args.rate
+deadline = time.monotonic()
 try:
-    stop_addr = int(sys.argv[2], 16)
-except:
-    pass
+    while True:
+        now = time.monotonic()
+        text = ''.join(view.draw_changes(now) for view in views)
+        if text:
+            sys.stdout.write(text)
+            sys.stdout.flush()
 
-# Start by clearing the screen
-print('\033[2J')
-ram = nes.fceu.open_shm()
-mark_time = [0]*len(ram)
-last_ram = None
-last_time = None
-while True:
-    now = time.time()
-    # Relocate the cursor and redraw overtop of the same matrix each time
-    print('\033[0;0f', end='')
-    ram_copy = ram[start_addr:stop_addr+1]
-    dump_ram(start_addr, ram_copy, mark_time)
-
-    if last_time != None:
-        for addr, (byte, last_byte) in enumerate(zip(ram_copy, last_ram)):
-            if byte != last_byte:
-                mark_time[addr] = MARK_TIME
-
-            elif mark_time[addr] > 0:
-                mark_time[addr] -= now-last_time
-    
-    last_ram = ram_copy
-    last_time = now
-    time.sleep(0.1)
+        deadline += delay
+        time.sleep(max(0, deadline-time.monotonic()))
+except KeyboardInterrupt:
+    pass
+finally:
+    sys.stdout.write(move_to(bottom+1, 1) + '\033[?25h')
+    sys.stdout.flush()
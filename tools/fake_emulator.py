@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Stands in for one or more running emulators, for testing the watcher (and
+# the other tools) without retroarch. Each fake emulator gets its own shm
+# segment, which it fills with frames from a recording or the RAM snapshots,
+# at the NES frame rate (or faster):
+#
+#   PYTHONPATH=. tools/fake_emulator.py --count 20 session.nesrec
+#   ./watch_for_high_scores.py '/dev/shm/fake-shm-*'
+#
+# Frames can be delayed by a random amount (--jitter), and the emulators
+# can be made to restart their ROM now and then (--restart-every), which
+# deletes the segment and creates it again a little later, like retroarch
+# does.
+#
+
+import argparse
+import glob
+import heapq
+import mmap
+import os
+import random
+import time
+
+from nes.recording import RecordingReader
+from sampling import FRAME_TIME
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS = os.path.join(ROOT, 'ram-snapshots', '*.bin')
+
+# NES RAM is 2k
+RAM_SIZE = 0x800
+
+class SnapshotSource:
+    '''Plays a list of RAM snapshots, holding each one for a while'''
+
+    def __init__(self, paths, hold):
+        self.frames = []
+        for path in paths:
+            with open(path, 'rb') as file:
+                self.frames.append(file.read())
+        self.hold = hold
+
+    def frames_from(self, start):
+        frame_number = start
+        while True:
+            yield self.frames[(frame_number // self.hold) % len(self.frames)]
+            frame_number += 1
+
+class RecordingSource:
+    '''Plays a recording, looping back to the start when it runs out'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def frames_from(self, start):
+        # Each emulator gets its own reader, since they share a file
+        # position
+        with RecordingReader(self.path) as reader:
+            start %= max(len(reader), 1)
+            while True:
+                count = 0
+                for timestamp, frame in reader.frames(start):
+                    count += 1
+                    yield frame
+                if not count:
+                    return
+                start = 0
+
+class FakeEmulator:
+    def __init__(self, path, source, start):
+        self.path = path
+        self.source = source
+        self.start = start
+        self.mm = None
+        self.frames = None
+        # When the next frame is due (before any jitter)
+        self.next_frame = None
+        self.written = 0
+        self.restarts = 0
+
+    def power_on(self):
+        '''Creates the shm segment and starts the ROM from the beginning'''
+        # Create it under another (hidden, so it won't match anyone's glob
+        # pattern) name first, so nobody maps it before it has the right size
+        tmp_path = os.path.join(
+            os.path.dirname(self.path),
+            '.%s.tmp' % os.path.basename(self.path))
+        with open(tmp_path, 'w+b') as file:
+            file.truncate(RAM_SIZE)
+            self.mm = mmap.mmap(file.fileno(), RAM_SIZE)
+        os.replace(tmp_path, self.path)
+        self.frames = self.source.frames_from(self.start)
+
+    def power_off(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def write_frame(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return
+        self.mm[:len(frame)] = frame
+        self.written += 1
+
+def find_sources(paths, hold):
+    if not paths:
+        return [SnapshotSource(sorted(glob.glob(SNAPSHOTS)), hold)]
+
+    sources = []
+    snapshots = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path.endswith('.bin'):
+                snapshots.append(path)
+            else:
+                sources.append(RecordingSource(path))
+    if snapshots:
+        sources.append(SnapshotSource(snapshots, hold))
+    return sources
+
+def run(emulators, rate, jitter, restart_every, restart_gap, duration):
+    interval = 1/rate
+    now = time.monotonic()
+    end = now + duration if duration else None
+
+    # (when, n, action) for every emulator, soonest first
+    events = []
+    for n, emulator in enumerate(emulators):
+        emulator.power_on()
+        emulator.next_frame = now
+        heapq.heappush(events, (now, n, 'frame'))
+        if restart_every:
+            heapq.heappush(events, (
+                now + random.expovariate(1/restart_every), n, 'off'))
+
+    late = 0
+    while events:
+        when, n, action = heapq.heappop(events)
+        delay = when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -interval:
+            late += 1
+        if end and when >= end:
+            break
+
+        emulator = emulators[n]
+        if action == 'frame':
+            if emulator.mm is not None:
+                emulator.write_frame()
+            # Keep to a grid (jitter is added on top of it) so the rate
+            # doesn't drift
+            emulator.next_frame += interval
+            next_time = emulator.next_frame
+            if jitter:
+                next_time += random.uniform(0, jitter)
+            heapq.heappush(events, (next_time, n, 'frame'))
+
+        elif action == 'off':
+            emulator.power_off()
+            emulator.restarts += 1
+            heapq.heappush(events, (when + restart_gap, n, 'on'))
+
+        elif action == 'on':
+            emulator.power_on()
+            heapq.heappush(events, (
+                when + random.expovariate(1/restart_every), n, 'off'))
+    return late
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pretends to be one or more NES emulators, writing RAM '
+        'frames from recordings or snapshots into shm segments')
+    parser.add_argument(
+        'sources', nargs='*',
+        help='recordings and/or RAM snapshots (.bin) to play, shared out '
+        'between the emulators (default is the snapshots in ram-snapshots)')
+    parser.add_argument(
+        '--count', type=int, default=1,
+        help='number of emulators to run (default %(default)s)')
+    parser.add_argument(
+        '--path', default='/dev/shm/fake-shm-%d',
+        help='shm segment path for each emulator, %%d is replaced by its '
+        'number (default %(default)s)')
+    parser.add_argument(
+        '--rate', type=float, default=1/FRAME_TIME,
+        help='frames per second (default %(default).4f)')
+    parser.add_argument(
+        '--jitter', type=float, default=0,
+        help='delay each frame by up to this many seconds')
+    parser.add_argument(
+        '--hold', type=int, default=60,
+        help='frames to show each snapshot for (default %(default)s)')
+    parser.add_argument(
+        '--restart-every', type=float, default=0,
+        help='restart each ROM on average this often (in seconds)')
+    parser.add_argument(
+        '--restart-gap', type=float, default=1,
+        help='how long a restarting emulator has no segment '
+        '(default %(default)s)')
+    parser.add_argument(
+        '--duration', type=float, default=0,
+        help='stop after this many seconds (default is to run until '
+        'interrupted)')
+    parser.add_argument(
+        '--keep', action='store_true',
+        help="don't remove the segments when stopping")
+    args = parser.parse_args()
+
+    sources = find_sources(args.sources, args.hold)
+    emulators = []
+    for n in range(args.count):
+        if '%' in args.path:
+            path = args.path % n
+        elif args.count == 1:
+            path = args.path
+        else:
+            path = '%s-%d' % (args.path, n)
+        # Spread the emulators out through their source, so they aren't
+        # all showing the same thing at the same time
+        emulators.append(FakeEmulator(
+            path, sources[n % len(sources)], n*997))
+        print('emulating %s' % path)
+
+    start = time.monotonic()
+    late = 0
+    try:
+        late = run(
+            emulators, args.rate, args.jitter, args.restart_every,
+            args.restart_gap, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not args.keep:
+            for emulator in emulators:
+                emulator.power_off()
+
+    elapsed = time.monotonic() - start
+    written = sum(emulator.written for emulator in emulators)
+    print('wrote %d frames in %.1fs (%.1f per emulator per second), '
+          '%d late' % (
+              written, elapsed, written/elapsed/len(emulators), late))
+    if args.restart_every:
+        print('%d restarts' % sum(
+            emulator.restarts for emulator in emulators))
+
+if __name__ == '__main__':
+    main()
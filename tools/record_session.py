@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import time
+import nes, nes.fceu
+from nes.recording import RecordingWriter, KEYFRAME_INTERVAL
+from sampling import FRAME_TIME
+
+parser = argparse.ArgumentParser(
+    description='Records NES RAM at frame rate until interrupted')
+parser.add_argument('output', help='recording file to write')
+parser.add_argument(
+    '--shm', default=nes.fceu.DEFAULT_SHM_PATH, help='shm segment to record')
+parser.add_argument(
+    '--keyframe-interval', type=int, default=KEYFRAME_INTERVAL,
+    help='frames between keyframes')
+args = parser.parse_args()
+
+ram = nes.fceu.open_ram(args.shm)
+with RecordingWriter(args.output, args.keyframe_interval) as writer:
+    deadline = time.monotonic()
+    try:
+        while True:
+            writer.write(ram.view)
+            # Keep to a fixed grid so we don't drift from the frame rate
+            deadline += FRAME_TIME
+            time.sleep(max(0, deadline-time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+
+print('recorded %d frames' % writer.frame_count)
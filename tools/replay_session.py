@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+from nes.ram import Ram
+from nes.recording import RecordingReader, replay
+from gamestate import GameState
+
+parser = argparse.ArgumentParser(
+    description='Replays a recording through the game state, printing '
+    'the events it triggers')
+parser.add_argument('recording', help='recording file to replay')
+parser.add_argument(
+    '--speed', type=float,
+    help='multiple of real time to play at (default is as fast as possible)')
+parser.add_argument(
+    '--start', type=int, default=0, help='frame number to start from')
+args = parser.parse_args()
+
+reader = RecordingReader(args.recording)
+ram = Ram(bytearray(reader.frame_size))
+game_state = GameState()
+
+frame_count = 0
+def on_frame():
+    global frame_count
+    if frame_count == 0:
+        game_state.rom_started(ram, game_id='tetris')
+    game_state.update()
+    frame_count += 1
+
+def print_event(signal):
+    def callback(game):
+        print('%d: %s' % (args.start+frame_count, signal))
+    return callback
+
+for signal in ('rom-ready', 'started-game', 'next-piece',
+               'finishing-game', 'finished-game'):
+    game_state.connect(signal, print_event(signal))
+
+replay(reader, ram, on_frame, start=args.start, speed=args.speed)
+print('replayed %d frames' % frame_count)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# nes-high-scorer -- tweets out high-scores achieved in NES games
+# Copyright (C) 2018  Peter Rogers (peter.rogers@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Measures how long the watcher takes from a cold start to its first sample
+# of the NES RAM. Each run starts a fresh interpreter with the watcher
+# pointed at a fake shm segment (a copy of one of the RAM snapshots) and an
+# empty config directory, and stops it as soon as the first sample is done.
+#
+# Results are printed as JSON. The exit status is non-zero if the median
+# time to the first sample is over --max-ms.
+#
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOT = os.path.join(ROOT, 'ram-snapshots', 'play1.bin')
+
+# Runs the watcher, writing the (wall clock) time when the import finished
+# and when the first sample was taken to a file, then exits
+CHILD = '''
+import os, sys, time
+import watch_for_high_scores as watcher
+imported = time.time()
+result_path = sys.argv.pop()
+poll = watcher.Cabinet.poll
+def first_poll(cabinet):
+    poll(cabinet)
+    if cabinet.ram is not None:
+        with open(result_path, 'w') as file:
+            file.write('%r %r' % (imported, time.time()))
+        os._exit(0)
+watcher.Cabinet.poll = first_poll
+sys.argv[0] = 'watch_for_high_scores.py'
+watcher.main()
+'''
+
+def run_once(shm_path, result_path, env):
+    start = time.time()
+    subprocess.run(
+        [sys.executable, '-c', CHILD, shm_path, result_path], env=env,
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        timeout=30)
+    with open(result_path) as file:
+        imported, sampled = map(float, file.read().split())
+    os.unlink(result_path)
+    return (imported - start, sampled - start)
+
+def time_interpreter(env):
+    start = time.time()
+    subprocess.run([sys.executable, '-c', 'pass'], env=env, check=True)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the time from starting the watcher to its '
+        'first RAM sample')
+    parser.add_argument(
+        '--runs', type=int, default=10,
+        help='number of times to start the watcher (default %(default)s)')
+    parser.add_argument(
+        '--max-ms', type=float, default=100,
+        help='fail if the median time to the first sample is over this '
+        '(default %(default)s)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='nes-startup-')
+    try:
+        shm_path = os.path.join(tmp_dir, 'fceu-shm')
+        shutil.copy(SNAPSHOT, shm_path)
+        env = dict(
+            os.environ, HOME=tmp_dir,
+            PYTHONPATH=os.pathsep.join(
+                [ROOT] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+
+        interpreter = [time_interpreter(env) for n in range(args.runs)]
+        # Throw away one run, so the files we load are in the page cache
+        result_path = os.path.join(tmp_dir, 'result')
+        run_once(shm_path, result_path, env)
+        runs = [
+            run_once(shm_path, result_path, env) for n in range(args.runs)]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    def summarize(times):
+        return {
+            'min_ms' : 1e3*min(times),
+            'median_ms' : 1e3*statistics.median(times),
+            'max_ms' : 1e3*max(times),
+        }
+
+    results = {
+        'runs' : args.runs,
+        'interpreter' : summarize(interpreter),
+        'import' : summarize([imported for imported, sampled in runs]),
+        'first_sample' : summarize([sampled for imported, sampled in runs]),
+    }
+    results['passed'] = results['first_sample']['median_ms'] <= args.max_ms
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if results['passed'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -17,30 +17,63 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import twitter
 import json
 
+from publishing import PermanentError
+
+# Twitter error codes for a tweet that will never be accepted: too long (186)
+# or a duplicate of one we already posted (187)
+REJECTED_CODES = (186, 187)
+
+def is_rejected(error):
+    '''Whether the twitter error means the tweet can't be posted at all'''
+    # twitter.TwitterError carries a list of {'code': ..., 'message': ...}
+    details = getattr(error, 'message', None)
+    if not isinstance(details, list):
+        return False
+    return any(
+        isinstance(detail, dict) and detail.get('code') in REJECTED_CODES
+        for detail in details)
+
 class Tweeter:
     def __init__(self, secrets_path):
+        # The secrets (and the twitter module, which is slow to import) are
+        # only loaded when we first tweet, so they aren't needed otherwise
         self.secrets_path = secrets_path
-        # Santiy check for secrets
-        self.read_secrets()
-    
+        self.api = None
+
     def read_secrets(self):
         return json.loads(open(self.secrets_path).read())
 
+    def get_api(self):
+        '''Returns the twitter client, connecting (and verifying our
+        credentials) the first time through'''
+        if not self.api:
+            import twitter
+            secrets = self.read_secrets()
+            api = twitter.Api(
+                consumer_key=secrets['consumer_key'],
+                consumer_secret=secrets['consumer_secret'],
+                access_token_key=secrets['access_token_key'],
+                access_token_secret=secrets['access_token_secret'])
+            api.VerifyCredentials()
+            self.api = api
+        return self.api
+
     def post_tweet(self, msg):
-        secrets = self.read_secrets()
-        api = twitter.Api(
-            consumer_key=secrets['consumer_key'],
-            consumer_secret=secrets['consumer_secret'],
-            access_token_key=secrets['access_token_key'],
-            access_token_secret=secrets['access_token_secret'])
-        api.VerifyCredentials()
-
-        status = api.PostUpdate(msg)
+        try:
+            status = self.get_api().PostUpdate(msg)
+        except Exception as e:
+            # Start over with a fresh connection next time
+            self.api = None
+            if is_rejected(e):
+                raise PermanentError(str(e))
+            raise
         print(status, status.text)
 
+    # So we can be used as a publishing backend
+    publish = post_tweet
+
     def make_tweet(self, entry):
         # Fix the name by stripping off trailing dashes (default when you
         # enter a high-score)
@@ -17,12 +17,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import twitter
 import os
 import nes, nes.fceu
-from nes import tetris
+from nes import shmwatch
+import fnmatch
+import glob
+import signal
 import time
-import sys
 
 #
 # TODO - at the moment this only supports high-scoring in tetris, but
@@ -35,46 +36,49 @@ import sys
 #
 # Make the folder '~/.config/nes-high-scorer/' and copy + paste the
 # credentials into a file there called 'secrets'. Have a look at the example
-# file 'secrets.sample'.
+# file 'secrets.sample'. (only needed with '--publish twitter')
 #
 
 from nes.tetris import DEFAULT_HIGH_SCORES
 from tweeting import Tweeter
-from gamestate import GameState
+from gamestate import GameState, QueuedDispatcher
+from sampling import SampleScheduler
+from leaderboard import Leaderboard
+from publishing import Publisher, NullBackend, FileBackend, HttpBackend
+import metrics
+from profiling import Profiler
+from telemetry import GameTelemetry
+from metrics import LatencyHistogram, Metric, COUNTER, GAUGE, HISTOGRAM
 import argparse
 
-# How frequently to check for a new high score
-DELAY = 0.5
+# How frequently to look for new shm segments matching the given patterns
+# (only when inotify isn't available to tell us)
+RESCAN_DELAY = 5
 
 def get_config_dir():
     return os.path.join(os.getenv('HOME'), '.config', 'nes-high-scorer')
 
+# We only look at the parts of the high-score that are relevant (eg rank can
+# change, but it's still considered the same score if other details match up)
+def essential(entry):
+    return (entry.game_type, entry.name, entry.score, entry.level)
+
+DEFAULT_ENTRIES = frozenset(map(essential, DEFAULT_HIGH_SCORES))
+
 class HighScoreTracker:
-    def __init__(self):
-        self.entries = []
+    def __init__(self, leaderboard, cabinet):
+        self.leaderboard = leaderboard
+        self.cabinet = cabinet
 
     def update(self, snapshot):
-        """Adds new high scores to the running list, given a snapshot of
-        the high-score table. This will return a list of newly added 
-        entries (ignoring anything already in this table)"""
-
-        # We only look at the parts of the high-score that are relevant
-        # (eg rank can change, but it's still considered the same score if
-        # other details match up)
-        def essential(entry):
-            return (entry.game_type, entry.name, entry.score, entry.level)
-        past_entries = set(
-            map(essential, self.entries + list(DEFAULT_HIGH_SCORES)))
-
-        print('Tracked entries:')
-        for arg in past_entries:
-            print(repr(arg))
-
-        new_entries = [
-            entry for entry in snapshot
-            if essential(entry) not in past_entries]
+        """Adds new high scores to the leaderboard, given a snapshot of
+        the high-score table. This will return a list of newly added
+        entries (ignoring anything already seen on this cabinet, including
+        before a restart)"""
 
-        print('')
+        new_entries = self.leaderboard.add_entries(self.cabinet, [
+            entry for entry in snapshot
+            if essential(entry) not in DEFAULT_ENTRIES])
 
         print('New entries:')
         for entry in new_entries:
@@ -84,98 +88,391 @@ class HighScoreTracker:
 
         print('')
 
-        #self.entries.update(new_entries)
-        self.entries = snapshot
         return new_entries
 
-# The NES ram (shared memory block)
-ram = None
-score_tracker = HighScoreTracker()
-tweeter = Tweeter(os.path.join(get_config_dir(), 'secrets'))
-
-points = []
-heights = []
-
-def started():
-    print('started')
-    points = []
-    height = []
-
-def finishing():
-    print('finishing')
-
-def next_piece():
-    print('next piece')
-    points.append(game_state.get_current_score())
-
-    height = 0
-    area = game_state.get_play_area()
-    for row, row_data in enumerate(area):
-        for col, cell in enumerate(row_data):
-            if cell != tetris.PLAY_AREA_EMPTY:
-                height = len(area)-row-1
-                break
-        if height > 0: break
-
-    heights.append(height)
-
-    print(points)
-    print(heights)
-
-def rom_ready():
-    # Update the high-score table. Wait a bit for the ROM to initialize
-    # while reading the high-score table.
-    while True:
-        entries = game_state.get_high_scores()
-        if entries:
-            score_tracker.update(entries)
-            break
-        time.sleep(1)
-
-def update_high_scores():
-    print('done')
-    # Now we can fetch the proper entries
-    entries = game_state.get_high_scores()
-    new_entries = score_tracker.update(entries)
-
-    if new_entries:
-        print('*** New high scores:')
-        for entry in new_entries:
-            msg = tweeter.make_tweet(entry)
-            print(msg)
-            #tweeter.post_tweet(msg)
-        print('')
-
-game_state = GameState()
-game_state.connect('started-game', started)
-game_state.connect('finishing-game', finishing)
-game_state.connect('finished-game', update_high_scores)
-game_state.connect('next-piece', next_piece)
-game_state.connect('rom-ready', rom_ready)
-
-while True:
-    if not nes.fceu.is_shm_available():
-        ram = None
-        game_state.rom_stopped()
-        time.sleep(DELAY)
-        continue
-
-    if not ram:
+class Cabinet:
+    """Watches the NES ram (shared memory block) of a single emulator"""
+
+    def __init__(self, path, tweeter, leaderboard, publisher,
+                 event_driven=False, dispatcher=None, telemetry_dir=None):
+        self.path = path
+        # Whether we're told about the segment coming and going (see
+        # segment_changed) rather than having to check for it ourselves
+        self.event_driven = event_driven
+        # Whether the segment is there. The event for waiting on it is made
+        # in run(), since the first sample is taken before asyncio is loaded
+        self.present = True
+        self.available = None
+        self.tweeter = tweeter
+        self.publisher = publisher
+        self.name = os.path.basename(path)
+        self.ram = None
+        self.score_tracker = HighScoreTracker(leaderboard, self.name)
+        self.scheduler = SampleScheduler()
+        # Where to save a record of each game (None to not bother)
+        self.telemetry_dir = telemetry_dir
+        self.telemetry = GameTelemetry()
+        self.poll_times = LatencyHistogram()
+        self.update_times = LatencyHistogram()
+
+        # By default the handlers below run on a worker thread (with a
+        # snapshot of the game state) so they never hold up sampling
+        self.game_state = GameState(dispatcher or QueuedDispatcher())
+        self.game_state.connect('started-game', self.started)
+        self.game_state.connect('finishing-game', self.finishing)
+        self.game_state.connect('finished-game', self.update_high_scores)
+        self.game_state.connect('next-piece', self.next_piece)
+        self.game_state.connect('rom-ready', self.rom_ready)
+
+    def log(self, *args):
+        print('[%s]' % self.name, *args)
+
+    def started(self, game):
+        self.log('started')
+        self.telemetry.reset()
+
+    def finishing(self, game):
+        self.log('finishing')
+
+    def next_piece(self, game):
+        # Imported here rather than at the top since it needs numpy, which
+        # is slow to load and isn't needed until a game is being played
+        from nes import board
+
+        self.log('next piece')
+        game_stats = game.get_game_stats()
+        area = game.get_play_area()
+        stats = board.analyze(area)
+        self.telemetry.record(
+            getattr(game, 'timestamp', None) or time.monotonic(),
+            game_stats.current_score or 0, stats.max_height,
+            game_stats.level, game_stats.lines or 0, game_stats.next_piece,
+            board.pack(area).to_bytes())
+
+        self.log(
+            'score %s, level %d, lines %s, height %d' % (
+                game_stats.current_score, game_stats.level, game_stats.lines,
+                stats.max_height))
+        self.log(
+            'holes %d, bumpiness %d, well depth %d, completed rows %s' % (
+                stats.holes, stats.bumpiness, stats.well_depth,
+                stats.completed_rows))
+
+    def rom_ready(self, game):
+        self.log('rom ready after %.2fs' % game.boot_time)
+        self.score_tracker.update(game.get_high_scores())
+
+    def update_high_scores(self, game):
+        self.log('done')
+        if self.telemetry_dir:
+            path = self.telemetry.flush(self.telemetry_dir, self.name)
+            if path:
+                self.log('saved telemetry to %s' % path)
+        else:
+            self.telemetry.reset()
+        self.log(
+            'sampling: {samples} samples, {late} late, {skipped} skipped, '
+            'max lag {max_lag:.3f}s'.format(**self.scheduler.get_stats()))
+        # Now we can fetch the proper entries
+        entries = game.get_high_scores()
+        new_entries = self.score_tracker.update(entries)
+
+        if new_entries:
+            self.log('*** New high scores:')
+            for entry in new_entries:
+                msg = self.tweeter.make_tweet(entry)
+                self.log(msg)
+                self.publisher.publish(msg)
+            print('')
+
+    def close_ram(self):
+        if self.ram is not None:
+            self.ram = None
+            self.game_state.rom_stopped()
+
+    def segment_changed(self, kind):
+        """Called when our shm segment is created, deleted or replaced"""
+        if kind != shmwatch.CREATED:
+            # Whatever we had mapped is stale now
+            self.close_ram()
+
+        self.set_available(kind != shmwatch.DELETED)
+
+    def set_available(self, present):
+        self.present = present
+        if self.available is not None:
+            if present:
+                self.available.set()
+            else:
+                self.available.clear()
+
+    def poll(self):
+        """Takes a single sample of the NES ram, (re)opening the shared
+        memory block as the emulator comes and goes"""
+        if not self.event_driven:
+            # Make sure the emulator hasn't gone away, or recreated the
+            # segment, since we mapped it
+            inode = shmwatch.get_inode(self.path)
+            if self.ram is not None and inode != self.ram.inode:
+                self.close_ram()
+            if inode is None:
+                self.game_state.rom_stopped()
+                return
+
+        if self.ram is None:
+            try:
+                self.ram = nes.fceu.open_ram(self.path)
+            except FileNotFoundError:
+                self.set_available(False)
+                return
+            except ValueError:
+                # The emulator hasn't sized the segment yet
+                return
+
+            self.game_state.rom_started(self.ram)
+
+        # Periodically update the game state
+        start = time.monotonic()
+        self.game_state.update()
+        self.update_times.record(time.monotonic()-start)
+
+    def collect_metrics(self):
+        labels = {'segment' : self.name}
+        yield Metric('nes_ram_mapped', GAUGE,
+                     'Whether the shm segment is mapped', labels,
+                     self.ram is not None)
+        yield Metric('nes_game_state', GAUGE,
+                     'Current game state (see GameState)', labels,
+                     self.game_state.state)
+        yield Metric('nes_poll_seconds', HISTOGRAM,
+                     'Time taken by each sample, including decoding', labels,
+                     self.poll_times)
+        yield Metric('nes_update_seconds', HISTOGRAM,
+                     'Time taken by GameState.update', labels,
+                     self.update_times)
+        yield from self.scheduler.collect_metrics(labels)
+        capture = self.game_state.capture
+        if capture:
+            yield Metric('nes_frame_retries_total', COUNTER,
+                         'RAM captures retried because the copy was torn',
+                         labels, capture.retries)
+            yield Metric('nes_frames_torn_total', COUNTER,
+                         'RAM captures still torn after all the retries',
+                         labels, capture.torn)
+        dispatcher = self.game_state.dispatcher
+        if hasattr(dispatcher, 'collect_metrics'):
+            yield from dispatcher.collect_metrics(labels)
+
+    async def run(self):
+        import asyncio
+
+        self.available = asyncio.Event()
+        self.set_available(self.present)
+        while True:
+            self.scheduler.begin()
+            start = time.monotonic()
+            self.poll()
+            self.poll_times.record(time.monotonic()-start)
+
+            if self.event_driven and not self.present:
+                # Nothing to do until the segment shows up
+                self.scheduler.pause()
+                await self.available.wait()
+            else:
+                # Sample quickly while a game is being played, but otherwise
+                # throttle back so we don't chew up CPU
+                await asyncio.sleep(
+                    self.scheduler.next_delay(self.game_state))
+
+def open_shm_watcher(patterns):
+    """Returns an inotify watcher for the directories holding the given
+    patterns, or None if we'll have to poll instead"""
+    directories = set(os.path.dirname(pattern) for pattern in patterns)
+    if any(glob.has_magic(directory) for directory in directories):
+        return None
+    try:
+        return shmwatch.ShmWatcher(directories)
+    except OSError as e:
+        print('not using inotify (%s), polling instead' % e)
+        return None
+
+class Watcher:
+    """The watcher application: runs one cabinet per shm segment matching
+    the given patterns, all driven from the same event loop. New segments
+    are picked up as they appear.
+
+    Setting up is kept cheap so we get to the first sample quickly. Anything
+    not needed for that (the twitter client and secrets, psutil, numpy) is
+    only loaded when something first uses it. Even asyncio is only loaded
+    after the first sample of each cabinet."""
+
+    def __init__(self, args):
+        self.args = args
+        self.patterns = args.paths
+        self.tweeter = Tweeter(os.path.join(get_config_dir(), 'secrets'))
+        self.profiler = Profiler(args.profile_dir, args.profile_seconds)
+        self.registry = metrics.Registry()
+        self.leaderboard = None
+        self.publisher = None
+        self.shm_watcher = None
+        self.cabinets = {}
+        self.loop = None
+        self.failed = None
+
+    def start(self):
+        os.makedirs(get_config_dir(), exist_ok=True)
+        self.leaderboard = Leaderboard(self.args.leaderboard)
+        self.publisher = Publisher(
+            get_publish_backend(self.args.publish, self.tweeter),
+            os.path.join(get_config_dir(), 'pending.json'))
+        self.registry.add_collector(self.publisher.collect_metrics)
+        self.shm_watcher = open_shm_watcher(self.patterns)
+
+    def close(self):
+        if self.shm_watcher:
+            self.shm_watcher.close()
+        if self.publisher:
+            self.publisher.close(timeout=1)
+
+    def run(self):
         try:
-            ram = nes.fceu.open_shm()
-        except FileNotFoundError:
-            time.sleep(DELAY)
-            continue
-
-        game_state.rom_started(ram)
-
-    # Periodically update the game state
-    game_state.update()
-
-    #area = game_state.get_play_area()
-    #print('')
-    #print('\n'.join(
-    #    ' '.join('%02x' % value for value in line) for line in area))
-
-    # Some throttling is needed so we don't chew up CPU
-    time.sleep(DELAY)
+            self.start()
+            # Sample every cabinet once before loading asyncio, which takes
+            # longer to import than everything else put together
+            self.add_cabinets(nes.fceu.find_shm_paths(self.patterns))
+            import asyncio
+
+            asyncio.run(self.watch())
+        finally:
+            self.close()
+
+    def check_task(self, task):
+        # Don't let a crashed cabinet die silently
+        if (not task.cancelled() and task.exception() and
+            not self.failed.done()):
+            self.failed.set_exception(task.exception())
+
+    def add_cabinets(self, paths):
+        for path in paths:
+            if path not in self.cabinets:
+                print('watching %s' % path)
+                cabinet = Cabinet(
+                    path, self.tweeter, self.leaderboard, self.publisher,
+                    event_driven=bool(self.shm_watcher),
+                    telemetry_dir=self.args.telemetry_dir)
+                self.cabinets[path] = cabinet
+                self.registry.add_collector(cabinet.collect_metrics)
+                if self.loop:
+                    self.start_cabinet(cabinet)
+                else:
+                    # The event loop isn't running yet (see run)
+                    cabinet.poll()
+
+    def start_cabinet(self, cabinet):
+        task = self.loop.create_task(cabinet.run())
+        task.add_done_callback(self.check_task)
+
+    def handle_shm_events(self):
+        for kind, path in self.shm_watcher.read_events():
+            if kind == shmwatch.OVERFLOW:
+                # We've missed events, so assume everything has changed
+                self.add_cabinets(nes.fceu.find_shm_paths(self.patterns))
+                for cabinet in self.cabinets.values():
+                    cabinet.segment_changed(kind)
+
+            elif path in self.cabinets:
+                self.cabinets[path].segment_changed(kind)
+
+            elif (kind != shmwatch.DELETED and
+                  any(fnmatch.fnmatch(path, pattern)
+                      for pattern in self.patterns)):
+                self.add_cabinets([path])
+
+    def start_profile(self):
+        if self.profiler.start():
+            print('profiling for %gs' % self.profiler.duration)
+        else:
+            print('already profiling')
+
+    async def watch(self):
+        import asyncio
+
+        loop = self.loop = asyncio.get_running_loop()
+        self.failed = loop.create_future()
+        # Carry on sampling the cabinets found in run() before anything else
+        for cabinet in self.cabinets.values():
+            self.start_cabinet(cabinet)
+        if self.shm_watcher:
+            loop.add_reader(
+                self.shm_watcher.fileno(), self.handle_shm_events)
+        loop.add_signal_handler(signal.SIGUSR1, self.start_profile)
+
+        metrics_server = None
+        try:
+            if self.args.metrics:
+                metrics_server = await metrics.serve(
+                    self.registry, self.args.metrics)
+            while True:
+                # With inotify we just wait for something to go wrong,
+                # otherwise we have to keep looking for new segments
+                done, pending = await asyncio.wait(
+                    [self.failed],
+                    timeout=None if self.shm_watcher else RESCAN_DELAY)
+                if done:
+                    self.failed.result()
+                self.add_cabinets(nes.fceu.find_shm_paths(self.patterns))
+        finally:
+            if self.shm_watcher:
+                loop.remove_reader(self.shm_watcher.fileno())
+            if metrics_server:
+                metrics_server.close()
+            loop.remove_signal_handler(signal.SIGUSR1)
+
+def get_publish_backend(spec, tweeter):
+    if spec == 'none':
+        return NullBackend()
+    if spec == 'twitter':
+        return tweeter
+    if spec.startswith('file:'):
+        return FileBackend(spec[len('file:'):])
+    if spec.startswith(('http://', 'https://')):
+        return HttpBackend(spec)
+    raise ValueError('unknown publishing backend: %s' % spec)
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Watches one or more NES emulators for new high scores')
+    parser.add_argument(
+        'paths', nargs='*', default=[nes.fceu.DEFAULT_SHM_PATH],
+        help='shm segments to watch (glob patterns like '
+        '"/dev/shm/fceu-shm-*" are allowed)')
+    parser.add_argument(
+        '--leaderboard',
+        default=os.path.join(get_config_dir(), 'leaderboard.db'),
+        help='database of every high score seen (default %(default)s)')
+    parser.add_argument(
+        '--publish', default='none',
+        help='where to publish new high scores: "twitter", "file:PATH", '
+        'an http(s) URL to POST to, or "none" (the default)')
+    parser.add_argument(
+        '--metrics', metavar='ADDRESS',
+        help='serve Prometheus metrics on "[host]:port" (localhost by '
+        'default) or a Unix socket path')
+    parser.add_argument(
+        '--profile-dir', default=os.path.join(get_config_dir(), 'profiles'),
+        help='where to write profiles, taken on SIGUSR1 (default '
+        '%(default)s)')
+    parser.add_argument(
+        '--profile-seconds', type=float, default=30,
+        help='how long each profile runs for (default %(default)s)')
+    parser.add_argument(
+        '--telemetry-dir', default=os.path.join(get_config_dir(), 'telemetry'),
+        help='where to save a record of each game played (default '
+        '%(default)s)')
+    return parser
+
+def main():
+    Watcher(get_arg_parser().parse_args()).run()
+
+if __name__ == '__main__':
+    main()